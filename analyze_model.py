@@ -15,8 +15,7 @@ import operator
 from functools import reduce
 import numpy as np
 import yaml
-import imp
-from run_training import make_paths_absolute
+from run_training import make_paths_absolute, load_modules
 import os
 import pprint
 import scipy.misc
@@ -290,9 +289,7 @@ if __name__ == "__main__":
     pp.pprint(config)
 
     # Load data module
-    dpath = config['dataset']['script_path']
-    sys.path.insert(1, os.path.dirname(dpath))
-    data = imp.load_source('data', config['dataset']['script_path'])
+    data = load_modules(config)['data']
 
     # Load model
     if args.model_path is not None:
@@ -6,22 +6,18 @@
 import logging
 import sys
 import yaml
-from keras.models import load_model
-from keras.preprocessing.image import ImageDataGenerator
 import numpy as np
 import io
 import csv
 import json
-import imp
 import pprint
 import collections
 import os
 import time
 import glob
-import pickle
 from operator import __mul__
-train_keras = imp.load_source('train_keras', "train/train_keras.py")
-from train_keras import get_level, handle_hierarchies, get_old_cli2new_cli
+from run_training import LazyModule, load_modules
+train_keras = LazyModule('train_keras', "train/train_keras.py")
 # from msthesis_utils import make_mosaic
 from run_training import make_paths_absolute
 try:
@@ -37,6 +33,7 @@ logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
 
 def run_model_prediction(model, config, X_train, X, n_classes):
     """Run (non)augmented model prediction."""
+    from keras.preprocessing.image import ImageDataGenerator
     t0 = time.time()
     if config['evaluate']['augmentation_factor'] > 1:
         # Test time augmentation
@@ -161,15 +158,11 @@ def _calculate_cm(config, model, X_train, X, y, n_classes, smooth):
             class_count[i] += 1
         for i in range(n_classes):
             cm[i] /= class_count[i]
+        cm_indices = None
     else:
-        cm_indices = [[[] for _ in range(n_classes)] for _ in range(n_classes)]
-        cm = np.zeros((n_classes, n_classes), dtype=np.int)
-        y_pred_i = y_pred.argmax(1)
-        index = 0
-        for i, j in zip(y_i, y_pred_i):
-            cm[i][j] += 1
-            cm_indices[i][j].append(index)
-            index += 1
+        cm_indices = train_keras.get_cm_indices(y_i, y_pred.argmax(1),
+                                                n_classes)
+        cm = np.diff(cm_indices['offsets']).reshape((n_classes, n_classes))
     return {'cm': cm, 'y_pred': y_pred,
             'cm_indices': cm_indices}
 
@@ -212,6 +205,7 @@ def create_cm(data_module, config, smooth, model_path, index_file,
                       .format(model_path))
         sys.exit(-1)
     logging.info("Load model {}".format(model_path))
+    from keras.models import load_model
     model = load_model(model_path)
     model.summary()
 
@@ -228,9 +222,9 @@ def create_cm(data_module, config, smooth, model_path, index_file,
     remaining_cls = [i for i in range(data_module.n_classes)]
     if 'hierarchy_path' in config['dataset']:
         # Calculate confusion matrix for test set
-        ret = handle_hierarchies(config, data_module,
-                                 X_train, y_train, X_test, y_test,
-                                 index_file)
+        ret = train_keras.handle_hierarchies(config, data_module,
+                                             X_train, y_train, X_test, y_test,
+                                             index_file)
         hierarchy = ret['hierarchy']
         X_train = ret['X_train']
         y_train = ret['y_train']
@@ -258,9 +252,8 @@ def create_cm(data_module, config, smooth, model_path, index_file,
                         smooth)
     cm = ret['cm']
 
-    with open('cm.indices.tmp.pickle', 'wb') as handle:
-        pickle.dump(ret['cm_indices'], handle,
-                    protocol=pickle.HIGHEST_PROTOCOL)
+    if ret['cm_indices'] is not None:
+        train_keras.save_cm_indices('cm.indices.tmp.npz', ret['cm_indices'])
 
     correct_count = sum([cm[i][i] for i in range(nb_classes)])
     acc = correct_count / float(cm.sum())
@@ -273,8 +266,9 @@ def create_cm(data_module, config, smooth, model_path, index_file,
 
     # Calculate the accuracy for each sub-group
     if 'hierarchy_path' in config['dataset']:
-        hierarchy = get_level(hierarchy, config['dataset']['subset'])
-        oldi2newi = get_old_cli2new_cli(hierarchy)
+        hierarchy = train_keras.get_level(hierarchy,
+                                          config['dataset']['subset'])
+        oldi2newi = train_keras.get_old_cli2new_cli(hierarchy)
         for class_group in hierarchy:
             if isinstance(class_group, collections.Iterable):
                 # calculate acc on this group
@@ -315,7 +309,8 @@ def get_parser():
                         help="Use prediction probability instead of argmax")
     parser.add_argument("--indices",
                         dest="index_file",
-                        help="Restrict the data to indices in this file.")
+                        help="Restrict the data to indices in this file "
+                             "(.npz written by this script or old .pickle).")
     return parser
 
 
@@ -330,8 +325,6 @@ if __name__ == '__main__':
                                           experiment_meta)
     pp = pprint.PrettyPrinter(indent=4)
     pp.pprint(experiment_meta)
-    dpath = experiment_meta['dataset']['script_path']
-    sys.path.insert(1, os.path.dirname(dpath))
-    data = imp.load_source('data', experiment_meta['dataset']['script_path'])
+    data = load_modules(experiment_meta)['data']
     create_cm(data, experiment_meta, args.smooth, args.model_fname,
               args.index_file)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compute the featurewise statistics (mean, std, ZCA covariance) of a dataset.
+
+The training data is preprocessed and read in chunks, so the full float
+dataset never has to be in memory. The resulting .npz file can be used as
+`statistics_path` in the `data_augmentation` section of an experiment.
+"""
+
+import logging
+import sys
+import os
+import pprint
+import yaml
+from run_training import make_paths_absolute, load_modules
+
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                    level=logging.DEBUG,
+                    stream=sys.stdout)
+
+
+def main(data_module, config, out_path, covariance=False, chunk_size=1000):
+    """
+    Compute the statistics of the training data of an experiment.
+
+    Parameters
+    ----------
+    data_module : module
+    config : dict
+    out_path : str
+        Where the .npz file gets stored
+    covariance : bool
+        Also compute the covariance matrix (needed for ZCA whitening)
+    chunk_size : int
+        Number of examples which get preprocessed at once
+    """
+    from keras import backend as K
+    # utils of the dataset scripts (data_module may not be loaded yet)
+    dataset_dir = os.path.dirname(os.path.abspath(data_module.__file__))
+    if dataset_dir not in sys.path:
+        sys.path.insert(1, dataset_dir)
+    from utils import RunningStatistics
+
+    data = data_module.load_data(config)
+    parts = [data['x_train']]
+    if not config['train'].get('use_val', True):
+        # train_keras trains on train + val in this case
+        parts.append(data['x_val'])
+
+    channel_axis = 0 if K.image_data_format() == 'channels_first' else -1
+    statistics = RunningStatistics(channel_axis=channel_axis,
+                                   covariance=covariance)
+    for x in parts:
+        for start in range(0, len(x), chunk_size):
+            chunk = data_module.preprocess(x[start:start + chunk_size])
+            statistics.update(chunk)
+        logging.info("Processed %i examples", statistics.n)
+    statistics.save(out_path)
+    logging.info("Statistics written to '%s'", out_path)
+
+
+def get_parser():
+    """Get parser object for script create_statistics.py."""
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-f", "--file",
+                        dest="filename",
+                        help="experiment definition file",
+                        metavar="FILE.yaml",
+                        required=True)
+    parser.add_argument("-o", "--out",
+                        dest="out_path",
+                        help="where the statistics get stored (default: "
+                             "statistics.npz in the artifacts path)",
+                        metavar="FILE.npz")
+    parser.add_argument("--zca",
+                        dest="covariance",
+                        action="store_true",
+                        default=False,
+                        help="compute the covariance for ZCA whitening")
+    parser.add_argument("--chunk_size",
+                        dest="chunk_size",
+                        type=int,
+                        default=1000,
+                        help="number of examples processed at once")
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    # Read YAML experiment definition file
+    with open(args.filename, 'r') as stream:
+        experiment_meta = yaml.load(stream)
+
+    # Make paths absolute
+    experiment_meta = make_paths_absolute(os.path.dirname(args.filename),
+                                          experiment_meta)
+    pp = pprint.PrettyPrinter(indent=4)
+    pp.pprint(experiment_meta)
+    out_path = args.out_path
+    if out_path is None:
+        out_path = os.path.join(experiment_meta['train']['artifacts_path'],
+                                'statistics.npz')
+    data = load_modules(experiment_meta)['data']
+    main(data, experiment_meta, out_path,
+         covariance=args.covariance, chunk_size=args.chunk_size)
@@ -12,10 +12,11 @@ http://www.vision.caltech.edu/Image_Datasets/Caltech101/
 import numpy as np
 import os
 import glob
+from functools import partial
 import scipy.misc
-from sklearn.model_selection import train_test_split
-from six.moves import cPickle as pickle
 from keras.utils.data_utils import get_file
+from utils import serialize, deserialize, read_images, load_statistics
+from utils import get_split_indices, parallel_map
 import logging
 import sys
 
@@ -84,71 +85,143 @@ def initialize(config):
             for class_fname in class_fnames:
                 x_fnames.append(class_fname)
                 y.append(i)
-        x_trainf, x_testf, y_trainf, y_testf = train_test_split(x_fnames, y,
-                                                                test_size=0.33,
-                                                                random_state=0,
-                                                                stratify=y)
-        tmp = train_test_split(x_trainf, y_trainf,
-                               test_size=0.10,
-                               random_state=0,
-                               stratify=y_trainf)
-        x_trainf, x_valf, y_trainf, y_valf = tmp
+        y = np.array(y, dtype=np.int64)
+        i_train, i_test, i_val = get_split_indices('caltech-101', y,
+                                                   [0.33, 0.10],
+                                                   random_state=0)
+        x_trainf = [x_fnames[i] for i in i_train]
+        x_valf = [x_fnames[i] for i in i_val]
+        x_testf = [x_fnames[i] for i in i_test]
+        y_trainf, y_valf, y_testf = y[i_train], y[i_val], y[i_test]
+        read_image = partial(prepreprocess_center,
+                             res_width=img_cols,
+                             res_height=img_rows,
+                             just_resize=just_resize)
+        n_jobs = config['dataset'].get('n_jobs')
+
         # Test data
-        x_test = []
-        for class_fname in x_testf:
-            gen = prepreprocess(class_fname, img_cols, img_rows,
-                                just_resize, only_center=True)
-            for gen_el in gen:
-                x_test.append(gen_el)
-        x_test = np.array(x_test, dtype=np.uint8)
+        x_test = read_images(x_testf, read_image, (img_rows, img_cols, 3),
+                             n_jobs=n_jobs)
         y_test = np.array(y_testf, dtype=np.int64)
 
         # Validation data
-        x_val = []
-        for class_fname in x_valf:
-            gen = prepreprocess(class_fname, img_cols, img_rows,
-                                just_resize, only_center=True)
-            for gen_el in gen:
-                x_val.append(gen_el)
-        x_val = np.array(x_val, dtype=np.uint8)
+        x_val = read_images(x_valf, read_image, (img_rows, img_cols, 3),
+                            n_jobs=n_jobs)
         y_val = np.array(y_valf, dtype=np.int64)
 
         # Training data
-        for class_fname, y in zip(x_trainf, y_trainf):
+        jobs = []
+        for img_index, (class_fname, y) in enumerate(zip(x_trainf,
+                                                         y_trainf)):
             class_name = os.path.basename(i2dirname[y])
             new_classpath = os.path.join(globals()["train_data_dir"],
                                          class_name)
             if not os.path.exists(new_classpath):
                 print("create {}".format(new_classpath))
                 os.makedirs(new_classpath)
-            gen = prepreprocess(class_fname, img_cols, img_rows,
-                                just_resize, only_center=False)
-            for gen_el in gen:
-                i = globals()["nb_train_samples"]
-                scipy.misc.imsave('{}/{}.jpg'.format(new_classpath, i),
-                                  gen_el)
-                globals()["nb_train_samples"] += 1
+            jobs.append((img_index, class_fname, new_classpath))
+        save_crops = partial(_save_crops,
+                             res_width=img_cols,
+                             res_height=img_rows,
+                             just_resize=just_resize)
+        for n_crops in parallel_map(save_crops, jobs, n_jobs=n_jobs,
+                                    chunksize=1):
+            globals()["nb_train_samples"] += n_crops
 
         data = {'x_val': x_val, 'y_val': y_val,
                 'x_test': x_test, 'y_test': y_test,
                 'labels': globals()["labels"],
                 'nb_train_samples': globals()["nb_train_samples"]}
 
-        with open(pickle_fpath, 'wb') as f:
-            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        serialize(pickle_fpath, data)
     else:
-        with open(pickle_fpath, 'rb') as f:
-            data = pickle.load(f)
+        data = deserialize(pickle_fpath)
         print(data['x_val'].shape)
         globals()["labels"] = data['labels']
         globals()["nb_train_samples"] = data['nb_train_samples']
     return data
 
 
-def prepreprocess(img_path, res_width, res_height, just_resize=False,
-                  only_center=True):
+def _resize_weights(in_size, out_size):
     """
-    Make image to size width x height.
+    Get the (out_size, in_size) matrix of a bilinear resize along one axis.
+
+    As in PIL, the triangle filter gets wider when the image is shrunk, so
+    every input pixel contributes to the result.
+    """
+    scale = float(in_size) / out_size
+    support = max(scale, 1.0)
+    centers = (np.arange(out_size) + 0.5) * scale
+    pixels = np.arange(in_size) + 0.5
+    weights = 1.0 - np.abs(pixels[np.newaxis, :] -
+                           centers[:, np.newaxis]) / support
+    weights = np.maximum(weights, 0)
+    return weights / weights.sum(axis=1, keepdims=True)
+
+
+def resize_batch(images, res_height, res_width):
+    """
+    Resize a batch of equally sized images bilinearly with one call.
+
+    Parameters
+    ----------
+    images : numpy array of shape (n, height, width, channels)
+    res_height : int
+    res_width : int
+
+    Returns
+    -------
+    numpy array of shape (n, res_height, res_width, channels), uint8
+    """
+    n, height, width, channels = images.shape
+    w_rows = _resize_weights(height, res_height).astype(np.float32)
+    w_cols = _resize_weights(width, res_width).astype(np.float32)
+    # The resize is separable: first the rows, then the columns
+    x = images.astype(np.float32).reshape(n, height, width * channels)
+    x = np.matmul(w_rows, x).reshape(n, res_height, width, channels)
+    x = np.matmul(w_cols, x)
+    return np.clip(np.rint(x), 0, 255).astype(np.uint8)
+
+
+def _get_crop_windows(im_height, im_width, res_width, res_height,
+                      only_center=True):
+    """
+    Get the crop windows of `get_crops`.
+
+    Returns
+    -------
+    windows : list of (top, left) tuples
+        The center crop is the first window.
+    cut_height : int
+    cut_width : int
+    """
+    # Images which are too small are treated as if they were on a bigger
+    # canvas; the crops themselves are taken from the image.
+    new_height = max(res_height, im_height)
+    new_width = max(res_width, im_width)
+
+    # Crop to correct aspect ratio
+    factor = min(new_width // res_width, new_height // res_height)
+    cut_height = factor * res_height
+    cut_width = factor * res_width
+    windows = [((new_height - cut_height) // 2, (new_width - cut_width) // 2)]
+    if not only_center:
+        x_pad_step = max((new_height - cut_height) // 2, 5)
+        y_pad_step = max((new_width - cut_width) // 2, 5)
+        windows += [(pad_top, pad_left)
+                    for pad_top in range(0, new_height - cut_height,
+                                         x_pad_step)
+                    for pad_left in range(0, new_width - cut_width,
+                                          y_pad_step)]
+    return windows, cut_height, cut_width
+
+
+def get_crops(img_path, res_width, res_height, just_resize=False,
+              only_center=True):
+    """
+    Get all crops of an image, resized to width x height.
+
+    All windows of the same size are resized together with `resize_batch`.
 
     Parameters
     ----------
@@ -156,61 +229,91 @@ def prepreprocess(img_path, res_width, res_height, just_resize=False,
     res_width : int
     res_height : int
     just_resize : bool
+        Resize the complete image instead of cropping it.
+    only_center : bool
+        Only take the center crop instead of the sliding windows.
 
     Returns
     -------
-    numpy array
+    numpy array of shape (n, res_height, res_width, 3)
     """
     try:
         im = scipy.misc.imread(img_path, mode='RGB')
     except:
         logging.error("Failed to load {}.".format(img_path))
-        yield np.zeros((res_height, res_width, 3), dtype=np.uint8)
-
-    if not just_resize:
-        channels = 3
-        im_height, im_width, _ = im.shape
-
-        # Put on bigger canvas if image is too small
-        new_height = max(res_height, im_height)
-        new_width = max(res_width, im_width)
-        im_new = np.zeros((new_height, new_width, channels), dtype=np.uint8)
-        pad_top = (new_height - im_height) / 2
-        pad_left = (new_width - im_width) / 2
-        for channel in range(channels):
-            im_new[pad_top:im_height + pad_top,
-                   pad_left:im_width + pad_left, channel] = im[:, :, channel]
-
-        # Crop to correct aspect ratio
-        factor = min(new_width / res_width, new_height / res_height)
-        cut_height = factor * res_height
-        cut_width = factor * res_width
-        pad_top = (new_height - cut_height) / 2
-        pad_left = (new_width - cut_width) / 2
-        im_cut = im[pad_top:pad_top + cut_height,
-                    pad_left:pad_left + cut_width, :]
-        # scale
-        im_cut = scipy.misc.imresize(im_cut, (res_height, res_width),
-                                     interp='bilinear')
-        yield im_cut
-        if not only_center:
-            x_pad_step = int((new_height - cut_height) / 2.)
-            x_pad_step = max(x_pad_step, 5)
-            y_pad_step = int((new_width - cut_width) / 2.)
-            y_pad_step = max(y_pad_step, 5)
-            for pad_top in range(0, new_height - cut_height, x_pad_step):
-                for pad_left in range(0, new_width - cut_width, y_pad_step):
-                    im_cut = im[pad_top:pad_top + cut_height,
-                                pad_left:pad_left + cut_width, :]
-                    # scale
-                    im_cut = scipy.misc.imresize(im_cut, (res_height, res_width),
-                                                 interp='bilinear')
-                    yield im_cut
-    else:
-        # scale
-        im = scipy.misc.imresize(im, (res_height, res_width),
-                                 interp='bilinear')
-        yield im
+        return np.zeros((1, res_height, res_width, 3), dtype=np.uint8)
+
+    if just_resize:
+        return resize_batch(im[np.newaxis], res_height, res_width)
+
+    im_height, im_width, _ = im.shape
+    windows, cut_height, cut_width = _get_crop_windows(im_height, im_width,
+                                                       res_width, res_height,
+                                                       only_center)
+    # Windows are cut off at the border of images which are too small
+    shapes = [(min(cut_height, im_height - top),
+               min(cut_width, im_width - left))
+              for top, left in windows]
+    crops = np.zeros((len(windows), res_height, res_width, 3), dtype=np.uint8)
+    for shape in sorted(set(shapes)):
+        indices = [i for i, el in enumerate(shapes) if el == shape]
+        cuts = np.stack([im[windows[i][0]:windows[i][0] + shape[0],
+                            windows[i][1]:windows[i][1] + shape[1]]
+                         for i in indices])
+        crops[indices] = resize_batch(cuts, res_height, res_width)
+    return crops
+
+
+def prepreprocess(img_path, res_width, res_height, just_resize=False,
+                  only_center=True):
+    """
+    Make image to size width x height.
+
+    Parameters
+    ----------
+    img_path : string
+    res_width : int
+    res_height : int
+    just_resize : bool
+
+    Returns
+    -------
+    generator of numpy arrays
+    """
+    for crop in get_crops(img_path, res_width, res_height, just_resize,
+                          only_center):
+        yield crop
+
+
+def _save_crops(job, res_width, res_height, just_resize):
+    """
+    Write all crops of a training image to its class directory.
+
+    Parameters
+    ----------
+    job : tuple
+        (index of the image, path of the image, class directory)
+
+    Returns
+    -------
+    int
+        Number of written crops
+    """
+    img_index, img_path, class_dir = job
+    crops = get_crops(img_path, res_width, res_height, just_resize,
+                      only_center=False)
+    for crop_index, crop in enumerate(crops):
+        scipy.misc.imsave(os.path.join(class_dir,
+                                       '{}-{}.jpg'.format(img_index,
+                                                          crop_index)),
+                          crop)
+    return len(crops)
+
+
+def prepreprocess_center(img_path, res_width, res_height, just_resize=False):
+    """Return only the center crop of `prepreprocess` (for `read_images`)."""
+    return next(prepreprocess(img_path, res_width, res_height, just_resize,
+                              only_center=True))
 
 
 def load_data(config):
@@ -246,44 +349,44 @@ def load_data(config):
         assert len(classes) == globals()["n_classes"]
         globals()["labels"] = [os.path.basename(el) for el in classes]
         assert len(globals()["labels"]) == globals()["n_classes"]
-        x = []
+        x_fnames = []
         y = []
         for i, class_path in enumerate(classes):
             class_path_glob = "{}/*.jpg".format(class_path)
             class_fnames = glob.glob(class_path_glob)
-            print("{}: Reading {} of {} in {}..."
+            print("{}: Found {} of {} in {}..."
                   .format(i,
                           len(class_fnames),
                           globals()["labels"][i],
                           class_path_glob))
-            for class_fname in class_fnames:
-                gen = prepreprocess(class_fname, img_cols, img_rows,
-                                    just_resize)
-                for gen_el in gen:
-                    x.append(gen_el)
-                    y.append(i)
-        x = np.array(x, dtype=np.uint8)
+            x_fnames += class_fnames
+            y += [i] * len(class_fnames)
         y = np.array(y, dtype=np.int64)
 
-        x_train, x_test, y_train, y_test = train_test_split(x, y,
-                                                            test_size=0.33,
-                                                            random_state=42,
-                                                            stratify=y)
-        x_train, x_val, y_train, y_val = train_test_split(x_train, y_train,
-                                                          test_size=0.10,
-                                                          random_state=42,
-                                                          stratify=y_train)
+        i_train, i_test, i_val = get_split_indices('caltech-101', y,
+                                                   [0.33, 0.10])
+
+        order = np.concatenate([i_train, i_val, i_test])
+        read_image = partial(prepreprocess_center,
+                             res_width=img_cols,
+                             res_height=img_rows,
+                             just_resize=just_resize)
+        x = read_images([x_fnames[i] for i in order], read_image,
+                        (img_rows, img_cols, 3),
+                        n_jobs=config['dataset'].get('n_jobs'))
+        n_train, n_val = len(i_train), len(i_val)
+        x_train, y_train = x[:n_train], y[i_train]
+        x_val, y_val = x[n_train:n_train + n_val], y[i_val]
+        x_test, y_test = x[n_train + n_val:], y[i_test]
 
         data = {'x_train': x_train, 'y_train': y_train,
                 'x_val': x_val, 'y_val': y_val,
                 'x_test': x_test, 'y_test': y_test,
                 'labels': globals()["labels"]}
 
-        with open(pickle_fpath, 'wb') as f:
-            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        serialize(pickle_fpath, data)
     else:
-        with open(pickle_fpath, 'rb') as f:
-            data = pickle.load(f)
+        data = deserialize(pickle_fpath)
         globals()["labels"] = data['labels']
     return data
 
@@ -297,7 +400,7 @@ def preprocess(x, subtact_mean=False):
     else:
         dir_path = os.path.dirname(os.path.realpath(__file__))
         mean_path = os.path.join(dir_path, _mean_filename)
-        mean_image = np.load(mean_path)
+        mean_image, _ = load_statistics(mean_path)
         x -= mean_image
         x /= 128.
     return x
@@ -309,8 +412,9 @@ if __name__ == '__main__':
                           'img_rows': 180}}
     data = load_data(config)
     print("len(data['x_train'])={}".format(len(data['x_train'])))
-    mean_image = np.mean(data['x_train'], axis=0)
-    np.save(_mean_filename, mean_image)
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    mean_image, _ = load_statistics(os.path.join(dir_path, _mean_filename),
+                                    data['x_train'])
     scipy.misc.imshow(mean_image)
     for img, label in zip(data['x_train'], data['y_train']):
         print(data['labels'][label])
@@ -12,10 +12,11 @@ http://www.vision.caltech.edu/Image_Datasets/Caltech256/
 import numpy as np
 import os
 import glob
+from functools import partial
 import scipy.misc
-from sklearn.model_selection import train_test_split
-from six.moves import cPickle as pickle
 from keras.utils.data_utils import get_file
+from utils import serialize, deserialize, read_images, load_statistics
+from utils import get_split_indices
 import logging
 import sys
 
@@ -33,29 +34,6 @@ img_cols = None
 _mean_filename = None
 
 
-def serialize(filename, data):
-    x_train_fname = "{}-x-train.npy".format(filename)
-    x_test_fname = "{}-x-test.npy".format(filename)
-    x_train = data['x_train']
-    x_test = data['x_test']
-    np.save(x_train_fname, data['x_train'])
-    np.save(x_test_fname, data['x_test'])
-    data['x_train'] = x_train_fname
-    data['x_test'] = x_test_fname
-    with open(filename, 'wb') as f:
-        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
-    data['x_train'] = x_train
-    data['x_test'] = x_test
-
-
-def deserialize(filename):
-    with open(filename, 'rb') as f:
-        data = pickle.load(f)
-    data['x_train'] = np.load(data['x_train'])
-    data['x_test'] = np.load(data['x_test'])
-    return data
-
-
 def prepreprocess(img_path, res_width, res_height, just_resize=False):
     """
     Make image to size width x height.
@@ -136,28 +114,32 @@ def load_data(config):
         assert len(classes) == globals()["n_classes"]
         globals()["labels"] = [os.path.basename(el) for el in classes]
         globals()["labels"] = [el.split(".")[1] for el in globals()["labels"]]
-        x = []
+        x_fnames = []
         y = []
         for i, class_path in enumerate(classes):
             class_path_glob = "{}/*.jpg".format(class_path)
             class_fnames = glob.glob(class_path_glob)
             print("{} in {}".format(len(class_fnames), class_path_glob))
-            print("Start reading {}".format(globals()["labels"][i]))
-            for class_fname in class_fnames:
-                x.append(prepreprocess(class_fname, img_cols, img_rows,
-                                       just_resize))
-                y.append(i)
-        x = np.array(x, dtype=np.uint8)
+            x_fnames += class_fnames
+            y += [i] * len(class_fnames)
         y = np.array(y, dtype=np.int64)
 
-        x_train, x_test, y_train, y_test = train_test_split(x, y,
-                                                            test_size=0.33,
-                                                            random_state=42,
-                                                            stratify=y)
-        x_train, x_val, y_train, y_val = train_test_split(x_train, y_train,
-                                                          test_size=0.10,
-                                                          random_state=42,
-                                                          stratify=y_train)
+        i_train, i_test, i_val = get_split_indices('caltech-256', y,
+                                                   [0.33, 0.10])
+
+        print("Start reading {} images".format(len(x_fnames)))
+        order = np.concatenate([i_train, i_val, i_test])
+        read_image = partial(prepreprocess,
+                             res_width=img_cols,
+                             res_height=img_rows,
+                             just_resize=just_resize)
+        x = read_images([x_fnames[i] for i in order], read_image,
+                        (img_rows, img_cols, 3),
+                        n_jobs=config['dataset'].get('n_jobs'))
+        n_train, n_val = len(i_train), len(i_val)
+        x_train, y_train = x[:n_train], y[i_train]
+        x_val, y_val = x[n_train:n_train + n_val], y[i_val]
+        x_test, y_test = x[n_train + n_val:], y[i_test]
 
         data = {'x_train': x_train, 'y_train': y_train,
                 'x_val': x_val, 'y_val': y_val,
@@ -179,7 +161,7 @@ def preprocess(x, subtact_mean=False):
     else:
         dir_path = os.path.dirname(os.path.realpath(__file__))
         mean_path = os.path.join(dir_path, _mean_filename)
-        mean_image = np.load(mean_path)
+        mean_image, _ = load_statistics(mean_path)
         x -= mean_image
         x /= 128.
     return x
@@ -190,8 +172,9 @@ if __name__ == '__main__':
                           'img_cols': 32,
                           'img_rows': 32}}
     data = load_data(config)
-    mean_image = np.mean(data['x_train'], axis=0)
-    np.save(_mean_filename, mean_image)
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    mean_image, _ = load_statistics(os.path.join(dir_path, _mean_filename),
+                                    data['x_train'])
     scipy.misc.imshow(mean_image)
     for img, label in zip(data['x_train'], data['y_train']):
         print(data['labels'][label])
@@ -15,9 +15,10 @@ import logging
 import os
 import sys
 import glob
+from functools import partial
 import scipy.misc
-from sklearn.model_selection import train_test_split
-from six.moves import cPickle as pickle
+from utils import serialize, deserialize, read_images, load_statistics
+from utils import get_split_indices
 
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
                     level=logging.DEBUG,
@@ -117,25 +118,25 @@ def load_data(config):
         print("{} in {}".format(len(dogs_fnames), dogs_path_glob))
 
         # Make np arrays
-        x = np.zeros((len(dogs_fnames) + len(cats_fnames),
-                      img_rows, img_cols, 3), dtype=np.uint8)
-        y = np.zeros((len(dogs_fnames) + len(cats_fnames), 1), dtype=np.uint64)
-        print("Start reading dogs")
-        for i, dog_fname in enumerate(dogs_fnames):
-            x[i, :, :, :] = prepreprocess(dog_fname, img_cols, img_rows)
-            y[i] = 1
-        print("Start reading cats")
-        for i, cat_fname in enumerate(cats_fnames, start=len(dogs_fnames)):
-            x[i, :, :, :] = prepreprocess(cat_fname, img_cols, img_rows)
-
-        x_train, x_test, y_train, y_test = train_test_split(x, y,
-                                                            test_size=0.33,
-                                                            random_state=42,
-                                                            stratify=y)
-        x_train, x_val, y_train, y_val = train_test_split(x_train, y_train,
-                                                          test_size=0.10,
-                                                          random_state=42,
-                                                          stratify=y_train)
+        x_fnames = dogs_fnames + cats_fnames
+        y = np.zeros((len(x_fnames), 1), dtype=np.uint64)
+        y[:len(dogs_fnames)] = 1
+
+        i_train, i_test, i_val = get_split_indices('cats-dogs', y,
+                                                   [0.33, 0.10])
+
+        print("Start reading dogs and cats")
+        order = np.concatenate([i_train, i_val, i_test])
+        read_image = partial(prepreprocess,
+                             res_width=img_cols,
+                             res_height=img_rows)
+        x = read_images([x_fnames[i] for i in order], read_image,
+                        (img_rows, img_cols, 3),
+                        n_jobs=config['dataset'].get('n_jobs'))
+        n_train, n_val = len(i_train), len(i_val)
+        x_train, y_train = x[:n_train], y[i_train]
+        x_val, y_val = x[n_train:n_train + n_val], y[i_val]
+        x_test, y_test = x[n_train + n_val:], y[i_test]
 
         # both = cats_fnames + dogs_fnames
         # from random import shuffle
@@ -147,11 +148,9 @@ def load_data(config):
                 'x_val': x_val, 'y_val': y_val,
                 'x_test': x_test, 'y_test': y_test}
 
-        with open(pickle_fpath, 'wb') as f:
-            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        serialize(pickle_fpath, data)
     else:
-        with open(pickle_fpath, 'rb') as f:
-            data = pickle.load(f)
+        data = deserialize(pickle_fpath)
 
     return data
 
@@ -165,7 +164,7 @@ def preprocess(x, subtact_mean=False):
     else:
         dir_path = os.path.dirname(os.path.realpath(__file__))
         mean_path = os.path.join(dir_path, _mean_filename)
-        mean_image = np.load(mean_path)
+        mean_image, _ = load_statistics(mean_path)
         x -= mean_image
         x /= 128.
     return x
@@ -179,8 +178,9 @@ if __name__ == "__main__":
     print("Training data n={}".format(len(data['x_train'])))
     print("Validation data n={}".format(len(data['x_val'])))
     print("Test data n={}".format(len(data['x_test'])))
-    mean_image = np.mean(data['x_train'], axis=0)
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    mean_image, _ = load_statistics(os.path.join(dir_path, _mean_filename),
+                                    data['x_train'])
     print("data['x_train'].shape={}".format(data['x_train'].shape))
     print("data['x_test'].shape={}".format(data['x_test'].shape))
-    np.save(_mean_filename, mean_image)
     scipy.misc.imshow(mean_image.squeeze())
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from utils import maybe_download_and_extract, DataSet
+from utils import maybe_download_and_extract, IndexedDataSet
 import os
 import cPickle
 import scipy.misc
@@ -15,8 +15,10 @@ meta = {'n_classes': 10,
         'image_height': 32,
         'image_depth': 3,
         'examples_per_epoch': -1}
-train_data = []
-test_data = []
+# Columnar storage: {'images': uint8 array of shape (n, 32, 32, 3),
+#                     'labels': int64 array, 'filenames': array of str}
+train_data = None
+test_data = None
 
 
 def _unpickle(file):
@@ -25,6 +27,18 @@ def _unpickle(file):
     return dict_
 
 
+def _to_columns(batches):
+    """Merge unpickled CIFAR batches into one columnar dict."""
+    data = np.concatenate([batch['data'] for batch in batches])
+    images = data.reshape((-1, 3, IMAGE_SIZE, IMAGE_SIZE))
+    images = np.ascontiguousarray(images.transpose((0, 2, 3, 1)))
+    labels = np.concatenate([batch['labels'] for batch in batches])
+    filenames = np.concatenate([batch['filenames'] for batch in batches])
+    return {'images': images,
+            'labels': labels.astype(np.int64),
+            'filenames': filenames}
+
+
 def prepare(data_dir):
     maybe_download_and_extract(dest_directory=DATA_DIR, data_url=DATA_URL)
     directory = os.path.join(DATA_DIR, 'cifar-10-batches-py')
@@ -33,6 +47,7 @@ def prepare(data_dir):
              'data_batch_5', 'test_batch']
     files = [os.path.abspath(os.path.join(directory, f))
              for f in files]
+    train_batches = []
     for f in files:
         if f.endswith("meta"):
             unpickled = _unpickle(f)
@@ -43,23 +58,12 @@ def prepare(data_dir):
             for index, labelname in enumerate(meta['label_names']):
                 meta['labelname2index'][labelname] = index
         elif f.endswith("test_batch"):
-            unpickled = _unpickle(f)
-            tu = unpickled['data'], unpickled['labels'], unpickled['filenames']
-            for img, label, filename in zip(tu[0], tu[1], tu[2]):
-                img = img.reshape((3, 32, 32)).transpose((1, 2, 0)).reshape(-1)
-                test_data.append({'img': img,
-                                  'label': label,
-                                  'filename': filename})
+            globals()['test_data'] = _to_columns([_unpickle(f)])
         else:
             # ['data', 'labels', 'batch_label', 'filenames']
-            unpickled = _unpickle(f)
-            tu = unpickled['data'], unpickled['labels'], unpickled['filenames']
-            for img, label, filename in zip(tu[0], tu[1], tu[2]):
-                img = img.reshape((3, 32, 32)).transpose((1, 2, 0)).reshape(-1)
-                train_data.append({'img': img,
-                                   'label': label,
-                                   'filename': filename})
-    meta['examples_per_epoch'] = len(train_data)
+            train_batches.append(_unpickle(f))
+    globals()['train_data'] = _to_columns(train_batches)
+    meta['examples_per_epoch'] = len(train_data['labels'])
 
 
 def inputs(eval_data, batch_size):
@@ -76,32 +80,34 @@ def inputs(eval_data, batch_size):
     -------
     Generator with
 
-    images: Images. 4D tensor of [batch_size, IMAGE_SIZE, IMAGE_SIZE, 3] size.
-    labels: Labels. 1D tensor of [batch_size] size.
+    images: Images. 4D uint8 view of [batch_size, IMAGE_SIZE, IMAGE_SIZE, 3].
+    labels: Labels. 1D view of [batch_size] size.
     """
-    images = np.zeros((batch_size, IMAGE_SIZE, IMAGE_SIZE, 3),
-                      dtype=np.float32)
-    labels = np.zeros(batch_size, dtype=np.int32)
     if eval_data:
         dataset = test_data
     else:
         dataset = train_data
     i = 0
-    while i + batch_size < len(dataset):
-        for j in range(batch_size):
-            images[j, :, :, :] = dataset[i + j]['img']
-            labels[j] = dataset[i + j]['label']
+    while i + batch_size < len(dataset['labels']):
+        yield (dataset['images'][i:i + batch_size],
+               dataset['labels'][i:i + batch_size])
         i += batch_size
-        yield images, labels
 
 
-def read_data_sets(validation_size=0.1):
-    test_images = np.array([el['img'] for el in test_data])
-    test_labels = np.array([el['label'] for el in test_data])
-    test_labels = np.eye(meta['n_classes'])[test_labels]
-    train_images = np.array([el['img'] for el in train_data])
-    train_labels = np.array([el['label'] for el in train_data])
-    train_labels = np.eye(meta['n_classes'])[train_labels]
+def read_data_sets(validation_size=0.1, n_buffers=1):
+    """
+    Get the training, validation and test DataSets.
+
+    `n_buffers` is the number of batch buffers of the training set (see
+    `IndexedDataSet`); a BatchPrefetcher with a queue of n batches needs
+    n + 2.
+    """
+    # Flat views of shape (n, 32 * 32 * 3); no copy of the images is made
+    test_images = test_data['images'].reshape((len(test_data['labels']), -1))
+    test_labels = np.eye(meta['n_classes'])[test_data['labels']]
+    train_images = train_data['images'].reshape((len(train_data['labels']),
+                                                 -1))
+    train_labels = np.eye(meta['n_classes'])[train_data['labels']]
 
     if 0 <= validation_size < 1.0:
         validation_size = int(validation_size * len(train_images))
@@ -122,26 +128,22 @@ def read_data_sets(validation_size=0.1):
     train_images = train_images[validation_size:]
     train_labels = train_labels[validation_size:]
 
-    train = DataSet(train_images, train_labels, dtype=np.float32)
-    validation = DataSet(validation_images,
-                         validation_labels,
-                         dtype=np.float32)
-    test = DataSet(test_images, test_labels, dtype=np.float32)
+    train = IndexedDataSet(train_images, train_labels, dtype=np.float32,
+                           n_buffers=n_buffers)
+    validation = IndexedDataSet(validation_images,
+                                validation_labels,
+                                dtype=np.float32)
+    test = IndexedDataSet(test_images, test_labels, dtype=np.float32)
 
     return base.Datasets(train=train, validation=validation, test=test)
 
 
 def visualize(identifier):
-    if identifier < len(train_data):
-        img = train_data[identifier]['img']
-        scipy.misc.imshow(img)
+    n_train = len(train_data['labels'])
+    if identifier < n_train:
+        img = train_data['images'][identifier]
     else:
-        identifier -= len(train_data)
-        img = test_data[identifier]['img']
-    img = img.reshape((meta['image_width'],
-                       meta['image_height'],
-                       meta['image_depth']))
-    img = img.transpose((2, 0, 1))
+        img = test_data['images'][identifier - n_train]
     scipy.misc.imshow(img)
 
 
@@ -6,12 +6,14 @@ from keras.utils.data_utils import get_file
 from keras import backend as K
 import numpy as np
 import os
-from sklearn.model_selection import train_test_split
+from utils import get_split_indices, load_statistics, convert_data_format
 
 n_classes = 10
 img_rows = 32
 img_cols = 32
 img_channels = 3
+# Layout of the pickled batches
+native_data_format = 'channels_first'
 
 labels = ["airplane", "automobile", "bird", "cat", "deer", "dog", "frog",
           "horse", "ship", "truck"]
@@ -32,30 +34,32 @@ def load_data(config):
     path = get_file(dirname, origin=origin, untar=True)
 
     num_train_samples = 50000
+    data_format = K.image_data_format()
 
-    x_train = np.zeros((num_train_samples, 3, 32, 32), dtype='uint8')
+    # The batches are converted while they are copied into x_train
+    if data_format == 'channels_last':
+        x_train = np.zeros((num_train_samples, 32, 32, 3), dtype='uint8')
+    else:
+        x_train = np.zeros((num_train_samples, 3, 32, 32), dtype='uint8')
     y_train = np.zeros((num_train_samples,), dtype='uint8')
 
     for i in range(1, 6):
         fpath = os.path.join(path, 'data_batch_' + str(i))
         data, labels = load_batch(fpath)
-        x_train[(i - 1) * 10000: i * 10000, :, :, :] = data
+        convert_data_format(data, native_data_format, data_format,
+                            out=x_train[(i - 1) * 10000: i * 10000])
         y_train[(i - 1) * 10000: i * 10000] = labels
 
     fpath = os.path.join(path, 'test_batch')
     x_test, y_test = load_batch(fpath)
+    x_test = convert_data_format(x_test, native_data_format, data_format)
 
     y_train = np.reshape(y_train, (len(y_train), 1))
     y_test = np.reshape(y_test, (len(y_test), 1))
 
-    if K.image_data_format() == 'channels_last':
-        x_train = x_train.transpose(0, 2, 3, 1)
-        x_test = x_test.transpose(0, 2, 3, 1)
-
-    x_train, x_val, y_train, y_val = train_test_split(x_train, y_train,
-                                                      test_size=0.10,
-                                                      random_state=42,
-                                                      stratify=y_train)
+    i_train, i_val = get_split_indices('cifar10', y_train, [0.10])
+    x_train, x_val = x_train[i_train], x_train[i_val]
+    y_train, y_val = y_train[i_train], y_train[i_val]
 
     return {'x_train': x_train, 'y_train': y_train,
             'x_val': x_val, 'y_val': y_val,
@@ -71,7 +75,7 @@ def preprocess(x, subtact_mean=False):
     else:
         dir_path = os.path.dirname(os.path.realpath(__file__))
         mean_path = os.path.join(dir_path, _mean_filename)
-        mean_image = np.load(mean_path)
+        mean_image, _ = load_statistics(mean_path)
         x -= mean_image
         x /= 128.
     return x
@@ -83,8 +87,9 @@ if __name__ == '__main__':
     print("Training data n={}".format(len(data['x_train'])))
     print("Validation data n={}".format(len(data['x_val'])))
     print("Test data n={}".format(len(data['x_test'])))
-    mean_image = np.mean(data['x_train'], axis=0)
-    np.save(_mean_filename, mean_image)
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    mean_image, _ = load_statistics(os.path.join(dir_path, _mean_filename),
+                                    data['x_train'])
     import scipy.misc
     scipy.misc.imshow(mean_image)
     for img, label in zip(data['x_train'], data['y_train']):
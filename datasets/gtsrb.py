@@ -16,16 +16,21 @@ from PIL import Image
 import numpy as np
 import os
 import glob
-import zipfile
-import shutil
 import csv
 import sys
 import random
 random.seed(0)
-from six.moves import cPickle as pickle
-from sklearn.model_selection import train_test_split
+from functools import partial
+from utils import serialize, deserialize, open_npy, read_images
+from utils import get_split_indices, load_statistics
+from utils import extract_archive, cached_data_format
 
-_mean_filename = "gtsrb-mean.npy"
+
+def _get_mean_filename():
+    """Get the file name of the mean image of the current image size."""
+    if (img_rows, img_cols) == (32, 32):
+        return "gtsrb-mean.npy"
+    return "gtsrb-{}-{}-mean.npy".format(img_rows, img_cols)
 
 
 labels = ['speed limit 20 (prohibitory)',
@@ -118,6 +123,8 @@ n_classes = len(labels)
 img_rows = 32
 img_cols = 32
 img_channels = 3
+# Layout of the cached images
+native_data_format = 'channels_last'
 train_img_paths = []
 train_img_rois = {}
 
@@ -157,22 +164,17 @@ def _maybe_download(url, fname, md5_hash):
     return fpath
 
 
+def _read_image(fname, size):
+    """Read a PPM image and resize it to size (rows, cols)."""
+    with Image.open(fname) as img:
+        img = img.resize((size[1], size[0]), PIL.Image.ANTIALIAS)
+        return np.array(img)
+
+
 def _maybe_extract(fpath, dirname, descend=True):
     path = os.path.dirname(fpath)
     untar_fpath = os.path.join(path, dirname)
-    if not os.path.exists(untar_fpath):
-        print('Extracting contents of "{}"...'.format(dirname))
-        tfile = zipfile.ZipFile(fpath, 'r')
-        try:
-            tfile.extractall(untar_fpath)
-        except (Exception, KeyboardInterrupt) as e:
-            if os.path.exists(untar_fpath):
-                if os.path.isfile(untar_fpath):
-                    os.remove(untar_fpath)
-                else:
-                    shutil.rmtree(untar_fpath)
-            raise
-        tfile.close()
+    extract_archive(fpath, untar_fpath)
     if descend:
         dirs = [os.path.join(untar_fpath, o)
                 for o in os.listdir(untar_fpath)
@@ -191,10 +193,18 @@ def load_data(config):
 
     If Tensorflow backend is used: (index, height, width, channels)
 
+    The images are resized to `config['dataset']['img_rows']` x
+    `config['dataset']['img_cols']` (default: 32 x 32). Every size is
+    decoded only once and cached as memory-mappable arrays.
+
     Returns
     -------
     dict
     """
+    globals()["img_rows"] = config['dataset'].get('img_rows', 32)
+    globals()["img_cols"] = config['dataset'].get('img_cols', 32)
+    n_jobs = config['dataset'].get('n_jobs')
+
     # Download if not already done
     url = 'http://benchmark.ini.rub.de/Dataset/'
     fname_train = 'GTSRB_Final_Training_Images.zip'
@@ -215,34 +225,36 @@ def load_data(config):
     test_dir_gt = _maybe_extract(fpath_test_gt, "GTSRB_Test_GT", descend=False)
 
     # Get labeled training data
-    pickle_fpath = os.path.join(test_diro, "data.pickle")
+    pickle_fpath = os.path.join(test_diro, "data-{}-{}.pickle"
+                                .format(img_rows, img_cols))
+    if (img_rows, img_cols) == (32, 32):
+        old_pickle_fpath = os.path.join(test_diro, "data.pickle")
+        if os.path.exists(old_pickle_fpath):
+            pickle_fpath = old_pickle_fpath
     if not os.path.exists(pickle_fpath):
+        shape = (img_rows, img_cols, img_channels)
+        read_image = partial(_read_image, size=(img_rows, img_cols))
+
         # Get train data
-        x_train = []
+        train_files = []
         y_train = []
         classes = sorted(glob.glob("{}/*".format(train_dir)))
         for class_path in classes:
             classi = int(os.path.basename(class_path))
             files = sorted(glob.glob("{}/*.ppm".format(class_path)))
-            globals()["train_img_paths"] += files
-            for file_ in files:
-                with Image.open(file_) as img:
-                    img = img.resize((32, 32), PIL.Image.ANTIALIAS)
-                    arr = np.array(img)
-                    x_train.append(arr)
-                y_train.append(classi)
-        x_train = np.array(x_train, dtype=np.uint8)
+            train_files += files
+            y_train += [classi] * len(files)
+        globals()["train_img_paths"] += train_files
+        x_train = open_npy(pickle_fpath, 'x_train',
+                           (len(train_files),) + shape)
+        read_images(train_files, read_image, shape, n_jobs=n_jobs,
+                    out=x_train)
         y_train = np.array(y_train, dtype=np.int64)
 
         # Get test data
-        x_test = []
         onlyfiles = sorted(glob.glob("{}/*.ppm".format(test_dir)))
-        for f in onlyfiles:
-            with Image.open(f) as img:
-                img = img.resize((32, 32), PIL.Image.ANTIALIAS)
-                arr = np.array(img)
-                x_test.append(arr)
-        x_test = np.array(x_test, dtype=np.uint8)
+        x_test = open_npy(pickle_fpath, 'x_test', (len(onlyfiles),) + shape)
+        read_images(onlyfiles, read_image, shape, n_jobs=n_jobs, out=x_test)
 
         # Get test GT
         y_test = []
@@ -260,22 +272,20 @@ def load_data(config):
                 'y_test': y_test}
 
         # Store data as pickle to speed up later calls
-        with open(pickle_fpath, 'wb') as f:
-            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        serialize(pickle_fpath, data)
 
     else:
-        with open(pickle_fpath, 'rb') as f:
-            data = pickle.load(f)
+        data = deserialize(pickle_fpath)
 
-    if K.image_dim_ordering() == 'th':
-        data['x_train'] = data['x_train'].transpose(0, 2, 3, 1)
-        data['x_test'] = data['x_test'].transpose(0, 2, 3, 1)
+    for key in ['x_train', 'x_test']:
+        data[key] = cached_data_format(pickle_fpath, key, data[key],
+                                       native_data_format,
+                                       K.image_data_format())
 
-    x_train, x_val, y_train, y_val = train_test_split(data['x_train'],
-                                                      data['y_train'],
-                                                      test_size=0.10,
-                                                      random_state=42,
-                                                      stratify=data['y_train'])
+    x_train, y_train = data['x_train'], data['y_train']
+    i_train, i_val = get_split_indices('gtsrb', y_train, [0.10])
+    x_train, x_val = x_train[i_train], x_train[i_val]
+    y_train, y_val = y_train[i_train], y_train[i_val]
 
     return {'x_train': x_train, 'y_train': y_train,
             'x_val': x_val, 'y_val': y_val,
@@ -292,8 +302,8 @@ def preprocess(x, subtact_mean=False):
         x /= 255.0
     else:
         dir_path = os.path.dirname(os.path.realpath(__file__))
-        mean_path = os.path.join(dir_path, _mean_filename)
-        mean_image = np.load(mean_path)
+        mean_path = os.path.join(dir_path, _get_mean_filename())
+        mean_image, _ = load_statistics(mean_path)
         x -= mean_image
         x /= 128.
     return x
@@ -305,8 +315,9 @@ if __name__ == '__main__':
     print("Training data n={}".format(len(data['x_train'])))
     print("Validation data n={}".format(len(data['x_val'])))
     print("Test data n={}".format(len(data['x_test'])))
-    mean_image = np.mean(data['x_train'], axis=0)
-    np.save(_mean_filename, mean_image)
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    mean_image, _ = load_statistics(os.path.join(dir_path, _get_mean_filename()),
+                                    data['x_train'])
     import scipy.misc
     scipy.misc.imshow(mean_image)
     for img, label in zip(data['x_train'], data['y_train']):
@@ -13,11 +13,10 @@ from keras import backend as K
 import numpy as np
 import scipy.ndimage
 import os
-import tarfile
-import shutil
 import csv
-from six.moves import cPickle as pickle
-from sklearn.model_selection import train_test_split
+from utils import serialize, deserialize, open_npy, read_images
+from utils import get_split_indices, load_statistics
+from utils import extract_archive, cached_data_format
 
 
 n_classes = 369
@@ -27,8 +26,11 @@ HEIGHT = 32
 img_rows = 32
 img_cols = 32
 img_channels = 1
+# Layout of the cached images
+native_data_format = 'channels_first'
 
 _mean_filename = "hasy-mean.npy"
+_n_folds = 10
 
 
 def _load_csv(filepath, delimiter=',', quotechar="'"):
@@ -87,6 +89,39 @@ def _generate_index(csv_filepath):
     return symbol_id2index, labels
 
 
+def _read_image(fname):
+    """Read a single HASY image as (1, WIDTH, HEIGHT) uint8 array."""
+    return scipy.ndimage.imread(fname, flatten=False, mode='L')[np.newaxis]
+
+
+def _add_fold_index(data, untar_fpath):
+    """
+    Add the indices of the examples of all classification folds to data.
+
+    The train (test) indices of fold k are
+    `fold_train[fold_train_offsets[k - 1]:fold_train_offsets[k]]`.
+    """
+    path2index = data['path2index']
+    for part in ['train', 'test']:
+        indices = []
+        for fold in range(1, _n_folds + 1):
+            fold_dir = os.path.join(untar_fpath,
+                                    "classification-task/fold-{}".format(fold))
+            csv_fpath = os.path.join(fold_dir, "{}.csv".format(part))
+            indices.append(np.array([path2index[row['path']]
+                                     for row in _load_csv(csv_fpath)],
+                                    dtype=np.int32))
+        offsets = np.cumsum([0] + [len(el) for el in indices])
+        data['fold_' + part] = np.concatenate(indices)
+        data['fold_{}_offsets'.format(part)] = offsets
+
+
+def _get_fold_indices(data, part, fold):
+    """Get the indices of the train or test examples of a fold."""
+    offsets = data['fold_{}_offsets'.format(part)]
+    return data['fold_' + part][offsets[fold - 1]:offsets[fold]]
+
+
 def load_data(config):
     """
     Load HASYv2 dataset.
@@ -106,7 +141,7 @@ def load_data(config):
     dict
         See "mode" parameter for details
     """
-    mode = 'fold-1'
+    mode = config['dataset'].get('mode', 'fold-1')
 
     # Download if not already done
     fname = 'HASYv2.tar.bz2'
@@ -117,19 +152,7 @@ def load_data(config):
 
     # Extract content if not already done
     untar_fpath = os.path.join(path, "HASYv2")
-    if not os.path.exists(untar_fpath):
-        print('Extract contents from archive...')
-        tfile = tarfile.open(fpath, 'r:bz2')
-        try:
-            tfile.extractall(path=untar_fpath)
-        except (Exception, KeyboardInterrupt) as e:
-            if os.path.exists(untar_fpath):
-                if os.path.isfile(untar_fpath):
-                    os.remove(untar_fpath)
-                else:
-                    shutil.rmtree(untar_fpath)
-            raise
-        tfile.close()
+    extract_archive(fpath, untar_fpath)
 
     # Create pickle if not already done
     pickle_fpath = os.path.join(untar_fpath, "hasy-data.pickle")
@@ -142,36 +165,33 @@ def load_data(config):
         # Load data
         data_csv_fpath = os.path.join(untar_fpath, "hasy-data-labels.csv")
         data_csv = _load_csv(data_csv_fpath)
-        x_compl = np.zeros((len(data_csv), 1, WIDTH, HEIGHT), dtype=np.uint8)
-        y_compl = []
-        s_compl = []
-        path2index = {}
-
-        # Load HASYv2 data
-        for i, data_item in enumerate(data_csv):
-            fname = os.path.join(untar_fpath, data_item['path'])
-            s_compl.append(fname)
-            x_compl[i, 0, :, :] = scipy.ndimage.imread(fname,
-                                                       flatten=False,
-                                                       mode='L')
-            label = symbol_id2index[data_item['symbol_id']]
-            y_compl.append(label)
-            path2index[fname] = i
-        y_compl = np.array(y_compl, dtype=np.int64)
+        s_compl = [os.path.join(untar_fpath, data_item['path'])
+                   for data_item in data_csv]
+        x_compl = open_npy(pickle_fpath, 'x',
+                           (len(data_csv), 1, WIDTH, HEIGHT))
+        read_images(s_compl, _read_image, (1, WIDTH, HEIGHT),
+                    n_jobs=config['dataset'].get('n_jobs'), out=x_compl)
+        y_compl = np.array([symbol_id2index[data_item['symbol_id']]
+                            for data_item in data_csv], dtype=np.int64)
+        path2index = dict((fname, i) for i, fname in enumerate(s_compl))
 
         data = {'x': x_compl,
                 'y': y_compl,
                 's': s_compl,
                 'labels': labels,
                 'path2index': path2index}
+        _add_fold_index(data, untar_fpath)
 
         # Store data as pickle to speed up later calls
-        with open(pickle_fpath, 'wb') as f:
-            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        serialize(pickle_fpath, data)
     else:
-        with open(pickle_fpath, 'rb') as f:
-            data = pickle.load(f)
+        data = deserialize(pickle_fpath)
         globals()["labels"] = data['labels']
+        if 'fold_train' not in data:
+            # cache of an older version
+            _add_fold_index(data, untar_fpath)
+            serialize(pickle_fpath, data)
+            data = deserialize(pickle_fpath)
 
     labels = data['labels']
     x_compl = data['x']
@@ -179,40 +199,36 @@ def load_data(config):
     s_compl = data['s']
     path2index = data['path2index']
 
-    if K.image_dim_ordering() == 'tf':
-        x_compl = x_compl.transpose(0, 2, 3, 1)
+    x_compl = cached_data_format(pickle_fpath, 'x', x_compl,
+                                 native_data_format, K.image_data_format())
 
     if mode == 'complete':
         return {'x': x_compl, 'y': y_compl}
     elif mode.startswith('fold-'):
         fold = int(mode.split("-")[1])
-        if not (1 <= fold <= 10):
+        if not (1 <= fold <= _n_folds):
             raise NotImplementedError
 
-        # Load fold
-        fold_dir = os.path.join(untar_fpath,
-                                "classification-task/fold-{}".format(fold))
-        train_csv_fpath = os.path.join(fold_dir, "train.csv")
-        test_csv_fpath = os.path.join(fold_dir, "test.csv")
-        train_csv = _load_csv(train_csv_fpath)
-        test_csv = _load_csv(test_csv_fpath)
+        train_ids = _get_fold_indices(data, 'train', fold)
+        test_ids = _get_fold_indices(data, 'test', fold)
+        y_train = y_compl[train_ids]
 
-        train_ids = np.array([path2index[row['path']] for row in train_csv])
-        test_ids = np.array([path2index[row['path']] for row in test_csv])
+        # Split positions within the fold, so x is indexed only once
+        i_train, i_val = get_split_indices('hasy-fold-{}'.format(fold),
+                                           y_train, [0.10])
+        val_ids = train_ids[i_val]
+        train_ids = train_ids[i_train]
 
         x_train = x_compl[train_ids]
+        x_val = x_compl[val_ids]
         x_test = x_compl[test_ids]
         y_train = y_compl[train_ids]
+        y_val = y_compl[val_ids]
         y_test = y_compl[test_ids]
         s_train = [s_compl[id_] for id_ in train_ids]
+        s_val = [s_compl[id_] for id_ in val_ids]
         s_test = [s_compl[id_] for id_ in test_ids]
 
-        splitd = train_test_split(x_train, y_train, s_train,
-                                  test_size=0.10,
-                                  random_state=42,
-                                  stratify=y_train)
-        x_train, x_val, y_train, y_val, s_train, s_val = splitd
-
         data = {'x_train': x_train,
                 'y_train': y_train,
                 'x_test': x_test,
@@ -238,7 +254,7 @@ def preprocess(x, subtact_mean=False):
     else:
         dir_path = os.path.dirname(os.path.realpath(__file__))
         mean_path = os.path.join(dir_path, _mean_filename)
-        mean_image = np.load(mean_path)
+        mean_image, _ = load_statistics(mean_path)
         x -= mean_image
         x /= 128.
     return x
@@ -250,8 +266,9 @@ if __name__ == '__main__':
     print("Training data n={}".format(len(data['x_train'])))
     print("Validation data n={}".format(len(data['x_val'])))
     print("Test data n={}".format(len(data['x_test'])))
-    mean_image = np.mean(data['x_train'], axis=0)
-    np.save(_mean_filename, mean_image)
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    mean_image, _ = load_statistics(os.path.join(dir_path, _mean_filename),
+                                    data['x_train'])
     import scipy.misc
     scipy.misc.imshow(mean_image.squeeze())
     for img, label in zip(data['x_train'], data['y_train']):
@@ -7,7 +7,7 @@ from keras.utils.data_utils import get_file
 import numpy as np
 import os
 import scipy.misc
-from sklearn.model_selection import train_test_split
+from utils import get_split_indices, load_statistics
 
 n_classes = 10
 labels = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
@@ -41,10 +41,9 @@ def load_data(config):
     y_test = f['y_test']
     f.close()
 
-    x_train, x_val, y_train, y_val = train_test_split(x_train, y_train,
-                                                      test_size=0.10,
-                                                      random_state=42,
-                                                      stratify=y_train)
+    i_train, i_val = get_split_indices('mnist', y_train, [0.10])
+    x_train, x_val = x_train[i_train], x_train[i_val]
+    y_train, y_val = y_train[i_train], y_train[i_val]
 
     return {'x_train': x_train, 'y_train': y_train,
             'x_val': x_val, 'y_val': y_val,
@@ -64,7 +63,7 @@ def preprocess(x, subtact_mean=False):
     else:
         dir_path = os.path.dirname(os.path.realpath(__file__))
         mean_path = os.path.join(dir_path, _mean_filename)
-        mean_image = np.load(mean_path)
+        mean_image, _ = load_statistics(mean_path)
         x -= mean_image
         x /= 128.
     x = x.reshape(x.shape[0], x.shape[1], x.shape[2], 1)
@@ -77,8 +76,9 @@ if __name__ == '__main__':
     print("Training data n={}".format(len(data['x_train'])))
     print("Validation data n={}".format(len(data['x_val'])))
     print("Test data n={}".format(len(data['x_test'])))
-    mean_image = np.mean(data['x_train'], axis=0)
-    np.save(_mean_filename, mean_image)
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    mean_image, _ = load_statistics(os.path.join(dir_path, _mean_filename),
+                                    data['x_train'])
     import scipy.misc
     scipy.misc.imshow(mean_image)
     for img, label in zip(data['x_train'], data['y_train']):
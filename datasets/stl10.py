@@ -15,7 +15,7 @@ https://cs.stanford.edu/~acoates/stl10/
 import numpy as np
 from keras.utils.data_utils import get_file
 import os
-from sklearn.model_selection import train_test_split
+from utils import get_split_indices, load_statistics
 
 n_classes = 10
 img_rows = 96  # height
@@ -44,10 +44,7 @@ def load_data(config):
     -------
     dict
     """
-    # url of the binary data
-    origin = 'http://ai.stanford.edu/~acoates/stl10/stl10_binary.tar.gz'
-    dirname = 'stl10_binary'
-    path = get_file(dirname, origin=origin, untar=True)
+    path = _maybe_download()
 
     # Load training data
     data_path = os.path.join(path, 'train_X.bin')
@@ -61,16 +58,55 @@ def load_data(config):
     x_test = read_all_images(data_path)
     y_test = read_labels(label_path)
 
-    x_train, x_val, y_train, y_val = train_test_split(x_train, y_train,
-                                                      test_size=0.10,
-                                                      random_state=42,
-                                                      stratify=y_train)
+    i_train, i_val = get_split_indices('stl10', y_train, [0.10])
+    x_train, x_val = x_train[i_train], x_train[i_val]
+    y_train, y_val = y_train[i_train], y_train[i_val]
 
     return {'x_train': x_train, 'y_train': y_train,
             'x_val': x_val, 'y_val': y_val,
             'x_test': x_test, 'y_test': y_test}
 
 
+def load_unlabeled():
+    """
+    Load the 100,000 unlabeled images of STL10.
+
+    Returns
+    -------
+    numpy array
+        Memory-mapped view of shape (100000, 96, 96, 3). Use `iter_chunks`
+        to process it without reading it into RAM at once.
+    """
+    return read_all_images(os.path.join(_maybe_download(), 'unlabeled_X.bin'))
+
+
+def iter_chunks(x, chunk_size=1000):
+    """
+    Iterate over an image array in chunks.
+
+    Parameters
+    ----------
+    x : numpy array
+        e.g. the result of `load_unlabeled`
+    chunk_size : int
+
+    Yields
+    ------
+    numpy array
+        Contiguous copy of the next (up to) `chunk_size` images
+    """
+    for start in range(0, len(x), chunk_size):
+        yield np.ascontiguousarray(x[start:start + chunk_size])
+
+
+def _maybe_download():
+    """Download and extract STL10, if not done yet. Return the directory."""
+    # url of the binary data
+    origin = 'http://ai.stanford.edu/~acoates/stl10/stl10_binary.tar.gz'
+    dirname = 'stl10_binary'
+    return get_file(dirname, origin=origin, untar=True)
+
+
 def read_labels(path_to_labels):
     """
     Read labels from the STL-10 binary dataset.
@@ -95,34 +131,31 @@ def read_all_images(path_to_data):
 
     Parameters
     ----------
-    path_to_data : strubg
+    path_to_data : string
         The file containing the binary images from the STL-10 dataset
 
     Returns
     -------
-    an array containing all the images
+    numpy array
+        A memory-mapped view of all images (n, 96, 96, 3). Nothing is read
+        before it is accessed.
     """
-    with open(path_to_data, 'rb') as f:
-        # read whole file in uint8 chunks
-        everything = np.fromfile(f, dtype=np.uint8)
-
-        # We force the data into 3x96x96 chunks, since the
-        # images are stored in "column-major order", meaning
-        # that "the first 96*96 values are the red channel,
-        # the next 96*96 are green, and the last are blue."
-        # The -1 is since the size of the pictures depends
-        # on the input file, and this way numpy determines
-        # the size on its own.
+    # copy-on-write: in-place changes never reach the file
+    everything = np.memmap(path_to_data, dtype=np.uint8, mode='c')
 
-        images = np.reshape(everything, (-1, 3, 96, 96))
+    # We force the data into 3x96x96 chunks, since the
+    # images are stored in "column-major order", meaning
+    # that "the first 96*96 values are the red channel,
+    # the next 96*96 are green, and the last are blue."
+    # The -1 is since the size of the pictures depends
+    # on the input file, and this way numpy determines
+    # the size on its own.
+    images = np.reshape(everything, (-1, DEPTH, WIDTH, HEIGHT))
 
-        # Now transpose the images into a standard image format
-        # readable by, for example, matplotlib.imshow
-        # You might want to comment this line or reverse the shuffle
-        # if you will use a learning algorithm like CNN, since they like
-        # their channels separated.
-        images = np.transpose(images, (0, 3, 2, 1))
-        return images
+    # Now transpose the images into a standard image format (n, rows,
+    # cols, channels). This is only a view on the file.
+    images = np.transpose(images, (0, 3, 2, 1))
+    return images
 
 
 def preprocess(x, subtact_mean=False):
@@ -134,7 +167,7 @@ def preprocess(x, subtact_mean=False):
     else:
         dir_path = os.path.dirname(os.path.realpath(__file__))
         mean_path = os.path.join(dir_path, _mean_filename)
-        mean_image = np.load(mean_path)
+        mean_image, _ = load_statistics(mean_path)
         x -= mean_image
         x /= 128.
     return x
@@ -146,8 +179,9 @@ if __name__ == '__main__':
     print("Training data n={}".format(len(data['x_train'])))
     print("Validation data n={}".format(len(data['x_val'])))
     print("Test data n={}".format(len(data['x_test'])))
-    mean_image = np.mean(data['x_train'], axis=0)
-    np.save(_mean_filename, mean_image)
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    mean_image, _ = load_statistics(os.path.join(dir_path, _mean_filename),
+                                    data['x_train'])
     import scipy.misc
     scipy.misc.imshow(mean_image)
     for img, label in zip(data['x_train'], data['y_train']):
@@ -14,7 +14,8 @@ from keras import backend as K
 import scipy.io
 import os
 import numpy as np
-from sklearn.model_selection import train_test_split
+from utils import serialize, deserialize, open_npy, get_split_indices
+from utils import load_statistics, cached_data_format
 
 
 labels = [str(i) for i in range(10)]
@@ -22,8 +23,12 @@ n_classes = len(labels)
 img_rows = 32
 img_cols = 32
 img_channels = 3
+# Layout of the cached images
+native_data_format = 'channels_last'
 
 _mean_filename = "svhn-mean.npy"
+_cache_filename = "svhn-32x32.pickle"
+_chunk_size = 10000
 
 
 def _replace_10(y):
@@ -38,9 +43,7 @@ def _replace_10(y):
     -------
     numpy array
     """
-    for i, el in enumerate(y):
-        if el == 10:
-            y[i] = 0
+    y[y == 10] = 0
     return y
 
 
@@ -74,40 +77,81 @@ def load_data(config):
     fpath_test = _maybe_download(url, fname_test, md5_test)
     fpath_extra = _maybe_download(url, fname_extra, md5_extra)
 
-    train_data = scipy.io.loadmat(fpath_train)
-    test_data = scipy.io.loadmat(fpath_test)
-    extra_data = scipy.io.loadmat(fpath_extra)
-    train_x, train_y = train_data['X'], _replace_10(train_data['y'])
-    extra_x, extra_y = extra_data['X'], _replace_10(extra_data['y'])
-    train_x = np.concatenate([train_x, extra_x], axis=-1)
-    train_y = np.concatenate([train_y, extra_y])
-    test_x, test_y = test_data['X'], _replace_10(test_data['y'])
-
-    data = {'x_train': train_x,
-            'y_train': train_y,
-            'x_test': test_x,
-            'y_test': test_y}
-
-    data['x_train'] = data['x_train'].transpose(3, 0, 1, 2)
-    data['x_test'] = data['x_test'].transpose(3, 0, 1, 2)
-
-    if K.image_dim_ordering() == 'th':
-        data['x_train'] = data['x_train'].transpose(0, 2, 3, 1)
-        data['x_test'] = data['x_test'].transpose(0, 2, 3, 1)
-
-    x_train, x_val, y_train, y_val = train_test_split(data['x_train'],
-                                                      data['y_train'],
-                                                      test_size=0.10,
-                                                      random_state=42,
-                                                      stratify=data['y_train'])
-    data['x_train'] = x_train
-    data['y_train'] = y_train
-    data['x_val'] = x_val
-    data['y_val'] = y_val
+    pickle_fpath = os.path.join(os.path.dirname(fpath_train),
+                                _cache_filename)
+    if not os.path.isfile(pickle_fpath):
+        _convert(pickle_fpath, [fpath_train, fpath_extra], fpath_test)
+    data = deserialize(pickle_fpath)
+
+    for key in ['x_train', 'x_val', 'x_test']:
+        data[key] = cached_data_format(pickle_fpath, key, data[key],
+                                       native_data_format,
+                                       K.image_data_format())
 
     return data
 
 
+def _n_examples(fpath):
+    """Get the number of images in a .mat file without loading it."""
+    for name, shape, _ in scipy.io.whosmat(fpath):
+        if name == 'X':
+            return shape[-1]
+
+
+def _read_mat(fpath, out):
+    """
+    Write the images of a .mat file channels-last to out.
+
+    Returns
+    -------
+    numpy array
+        The labels
+    """
+    mat = scipy.io.loadmat(fpath)
+    x = mat['X']
+    for start in range(0, x.shape[-1], _chunk_size):
+        end = start + _chunk_size
+        out[start:end] = x[..., start:end].transpose(3, 0, 1, 2)
+    return _replace_10(mat['y'])
+
+
+def _convert(pickle_fpath, fpaths_train, fpath_test):
+    """
+    Convert the .mat files to memory-mappable uint8 arrays (channels last).
+
+    The training files are joined and split into train / val. Nothing has
+    to fit into RAM except a single .mat file.
+    """
+    shape = (img_rows, img_cols, img_channels)
+    n_examples = [_n_examples(fpath) for fpath in fpaths_train]
+    x_all = open_npy(pickle_fpath, 'x_all', (sum(n_examples),) + shape)
+    y_all = []
+    offset = 0
+    for fpath, n in zip(fpaths_train, n_examples):
+        y_all.append(_read_mat(fpath, x_all[offset:offset + n]))
+        offset += n
+    y_all = np.concatenate(y_all)
+
+    i_train, i_val = get_split_indices('svhn', y_all, [0.10])
+    data = {}
+    for key, indices in [('train', i_train), ('val', i_val)]:
+        x = open_npy(pickle_fpath, 'x_' + key, (len(indices),) + shape)
+        for start in range(0, len(indices), _chunk_size):
+            end = start + _chunk_size
+            x[start:end] = x_all[indices[start:end]]
+        data['x_' + key] = x
+        data['y_' + key] = y_all[indices]
+    x_all_fpath = x_all.filename
+    del x_all
+    os.remove(x_all_fpath)
+
+    x_test = open_npy(pickle_fpath, 'x_test',
+                      (_n_examples(fpath_test),) + shape)
+    data['y_test'] = _read_mat(fpath_test, x_test)
+    data['x_test'] = x_test
+    serialize(pickle_fpath, data)
+
+
 def preprocess(x, subtact_mean=False):
     """Preprocess features."""
     x = x.astype('float32')
@@ -117,7 +161,7 @@ def preprocess(x, subtact_mean=False):
     else:
         dir_path = os.path.dirname(os.path.realpath(__file__))
         mean_path = os.path.join(dir_path, _mean_filename)
-        mean_image = np.load(mean_path)
+        mean_image, _ = load_statistics(mean_path)
         x -= mean_image
         x /= 128.
     return x
@@ -129,8 +173,9 @@ if __name__ == '__main__':
     print("Training data n={}".format(len(data['x_train'])))
     print("Validation data n={}".format(len(data['x_val'])))
     print("Test data n={}".format(len(data['x_test'])))
-    mean_image = np.mean(data['x_train'], axis=0)
-    np.save(_mean_filename, mean_image)
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    mean_image, _ = load_statistics(os.path.join(dir_path, _mean_filename),
+                                    data['x_train'])
     import scipy.misc
     scipy.misc.imshow(mean_image)
     for img, label in zip(data['x_train'], data['y_train']):
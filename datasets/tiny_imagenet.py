@@ -9,26 +9,26 @@ from keras.utils.data_utils import get_file
 from keras import backend as K
 import numpy as np
 import os
-import zipfile
-import shutil
 import sys
 import glob
+from functools import partial
 import scipy.misc
 import PIL
 from PIL import Image
 import csv
-from six.moves import cPickle as pickle
+from utils import load_statistics, extract_archive
+from utils import has_records, write_records, RecordStore
+from utils import data_format_axes
 
 n_classes = 200
 img_rows = 64
 img_cols = 64
 img_channels = 3
+# Layout of the records
+native_data_format = 'channels_last'
 labels = None
 
 _mean_filename = "tiny-imagenet-mean.npy"
-train_img_paths = []
-test_img_paths = []
-val_img_paths = []
 wnid2word = {}
 
 
@@ -41,19 +41,7 @@ def _maybe_download(url, fname, md5_hash):
 def _maybe_extract(fpath, dirname, descend=True):
     path = os.path.dirname(fpath)
     untar_fpath = os.path.join(path, dirname)
-    if not os.path.exists(untar_fpath):
-        print('Extracting contents of "{}"...'.format(dirname))
-        tfile = zipfile.ZipFile(fpath, 'r')
-        try:
-            tfile.extractall(untar_fpath)
-        except (Exception, KeyboardInterrupt) as e:
-            if os.path.exists(untar_fpath):
-                if os.path.isfile(untar_fpath):
-                    os.remove(untar_fpath)
-                else:
-                    shutil.rmtree(untar_fpath)
-            raise
-        tfile.close()
+    extract_archive(fpath, untar_fpath)
     if descend:
         dirs = [os.path.join(untar_fpath, o)
                 for o in os.listdir(untar_fpath)
@@ -66,45 +54,35 @@ def _maybe_extract(fpath, dirname, descend=True):
         return untar_fpath
 
 
-def _get_train_data(train_dir, global_name):
-    x_train = []
+def _read_image(file_, resize=True):
+    """Read one image as RGB uint8 array, optionally resized."""
+    img = scipy.misc.imread(file_, mode='RGB')
+    if resize:
+        img = Image.fromarray(img)
+        img = img.resize((img_rows, img_cols), PIL.Image.ANTIALIAS)
+    return np.array(img, dtype=np.uint8)
+
+
+def _get_train_files(train_dir):
+    files = []
     y_train = []
     classes = sorted(glob.glob("{}/*".format(train_dir)))
     for class_path in classes:
         class_name = os.path.basename(class_path)
         class_path_i = os.path.join(class_path, 'images')
-        files = sorted(glob.glob("{}/*.JPEG".format(class_path_i)))
-        globals()[global_name] += files
-        for file_ in files:
-            img = scipy.misc.imread(file_, mode='RGB')
-            img = Image.fromarray(img)
-            img = img.resize((img_rows, img_cols), PIL.Image.ANTIALIAS)
-            arr = np.array(img, dtype=np.uint8)
-            x_train.append(arr)
-            y_train.append(globals()['labels'].index(class_name))
-    x_train = np.array(x_train, dtype=np.uint8)
+        class_files = sorted(glob.glob("{}/*.JPEG".format(class_path_i)))
+        files += class_files
+        y_train += [globals()['labels'].index(class_name)] * len(class_files)
     y_train = np.array(y_train, dtype=np.int64)
-    return x_train, y_train
+    return files, y_train
 
 
-def _get_test_data(dir_, global_name):
-    x_train = []
+def _get_test_files(dir_):
     files = sorted(glob.glob("{}/*.JPEG".format(dir_)))
-    globals()[global_name] += files
-    for file_ in files:
-        img = scipy.misc.imread(file_, mode='RGB')
-        img = Image.fromarray(img)
-        img = img.resize((img_rows, img_cols), PIL.Image.ANTIALIAS)
-        arr = np.array(img, dtype=np.uint8)
-        x_train.append(arr)
-    x_train = np.array(x_train, dtype=np.uint8)
-    return x_train
+    return files, None
 
 
-def _get_val_data(train_dir, global_name):
-    x_train = []
-    y_train = []
-
+def _get_val_files(train_dir):
     # Read CSV file
     with open(os.path.join(train_dir, "val_annotations.txt"), 'r') as fp:
         reader = csv.reader(fp, delimiter='\t', quotechar='"')
@@ -115,18 +93,22 @@ def _get_val_data(train_dir, global_name):
     for ann in annotations:
         fname2cl[ann[0]] = globals()['labels'].index(ann[1])
 
-    # Read images
     train_dir = os.path.join(train_dir, "images")
     files = sorted(glob.glob("{}/*.JPEG".format(train_dir)))
-    globals()[global_name] += files
-    for file_ in files:
-        img = scipy.misc.imread(file_, mode='RGB')
-        arr = np.array(img, dtype=np.uint8)
-        x_train.append(arr)
-        y_train.append(fname2cl[os.path.basename(file_)])
-    x_train = np.array(x_train, dtype=np.uint8)
+    y_train = [fname2cl[os.path.basename(file_)] for file_ in files]
     y_train = np.array(y_train, dtype=np.int64)
-    return x_train, y_train
+    return files, y_train
+
+
+def _get_records(path, files, labels, read_image, n_jobs=None):
+    """Open the record store at path; decode the images first if needed."""
+    if not has_records(path):
+        write_records(path, files, read_image,
+                      (img_rows, img_cols, img_channels),
+                      labels=labels, n_jobs=n_jobs)
+    # Batches are converted to the training layout when they are read
+    return RecordStore(path, axes=data_format_axes(native_data_format,
+                                                   K.image_data_format()))
 
 
 def load_data(config):
@@ -163,49 +145,36 @@ def load_data(config):
 
     globals()['wnid2word'] = wnid2word
 
-    # Get labeled training data
-    pickle_fpath = os.path.join(train_dir, "data.pickle")
-    if not os.path.exists(pickle_fpath):
-        # Get train data
-        x_train, y_train = _get_train_data(train_dir, "train_img_paths")
-        x_test = _get_test_data(test_dir, "test_img_paths")
-        x_val, y_val = _get_val_data(val_dir, "val_img_paths")
-
-        data = {'x_train': x_train, 'y_train': y_train,
-                'x_val': x_val, 'y_val': y_val,
-                'x_test': x_test,
-                'train_img_paths': globals()['train_img_paths'],
-                'test_img_paths': globals()['test_img_paths'],
-                'val_img_paths': globals()['val_img_paths']}
-
-        # Store data as pickle to speed up later calls
-        with open(pickle_fpath, 'wb') as f:
-            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
-    else:
-        with open(pickle_fpath, 'rb') as f:
-            data = pickle.load(f)
-
-    perm = np.random.permutation(len(data['x_train']))
-    data['x_train'] = data['x_train'][perm]
-    data['y_train'] = data['y_train'][perm]
-
-    if K.image_dim_ordering() == 'th':
-        data['x_train'] = data['x_train'].transpose(0, 2, 3, 1)
-        data['x_test'] = data['x_test'].transpose(0, 2, 3, 1)
+    # The decoded images are stored as memory-mapped records, so only the
+    # examples of a batch are read from disk
+    records_dir = os.path.join(main_dir, "records")
+    n_jobs = config['dataset'].get('n_jobs')
+    splits = [('train', _get_train_files(train_dir), _read_image),
+              ('val', _get_val_files(val_dir),
+               partial(_read_image, resize=False)),
+              ('test', _get_test_files(test_dir), _read_image)]
+    data = {}
+    for split, (files, y), read_image in splits:
+        records = _get_records(os.path.join(records_dir, split),
+                               files, y, read_image, n_jobs=n_jobs)
+        data['x_{}'.format(split)] = records
+        data['{}_img_paths'.format(split)] = records.fnames
+        if records.labels is not None:
+            data['y_{}'.format(split)] = records.labels
 
     return data
 
 
 def preprocess(x, subtact_mean=False):
     """Preprocess features."""
-    x = x.astype('float32')
+    x = np.array(x, dtype='float32')
 
     if not subtact_mean:
         x /= 255.0
     else:
         dir_path = os.path.dirname(os.path.realpath(__file__))
         mean_path = os.path.join(dir_path, _mean_filename)
-        mean_image = np.load(mean_path)
+        mean_image, _ = load_statistics(mean_path)
         x -= mean_image
         x /= 128.
     return x
@@ -218,6 +187,7 @@ if __name__ == '__main__':
     for x, y in zip(data['x_train'][:n], data['y_train'][:n]):
         print(globals()['wnid2word'][labels[y]])
         scipy.misc.imshow(x)
-    mean_image = np.mean(data['x_train'], axis=0)
-    np.save(_mean_filename, mean_image)
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    mean_image, _ = load_statistics(os.path.join(dir_path, _mean_filename),
+                                    data['x_train'])
     scipy.misc.imshow(mean_image)
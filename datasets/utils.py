@@ -2,13 +2,216 @@
 
 """Utility functions for loading Computer Vision datasets."""
 
+import copy
+import hashlib
+import json
+import multiprocessing
 import os
 import sys
 import tarfile
+import zipfile
+from six import integer_types, string_types
 from six.moves import urllib
+from six.moves import cPickle as pickle
 # from tensorflow.contrib.learn.python.learn.datasets import base
 from tensorflow.python.framework import dtypes
 import numpy as np
+from sklearn.model_selection import train_test_split
+
+_split_dir = os.path.join(os.path.expanduser('~'), '.keras', 'datasets',
+                          'splits')
+
+
+def download(data_url, filepath, chunk_size=2**20, md5_hash=None):
+    """
+    Download a file, resuming an interrupted download.
+
+    The data is written to `filepath + '.part'` first. If that file exists,
+    only the missing bytes are requested (HTTP range request). If the server
+    answers that the range is not satisfiable (HTTP 416), the '.part' file
+    already is complete. Nothing is done if `filepath` exists.
+
+    Parameters
+    ----------
+    data_url : str
+        URL, file:// URL or path of a local file (e.g. on a mirror)
+    filepath : str
+    chunk_size : int, optional
+    md5_hash : str, optional
+        Expected MD5 hex digest of the file. On a mismatch the '.part' file
+        is removed and a ValueError is raised.
+
+    Returns
+    -------
+    str
+        filepath
+    """
+    if os.path.exists(filepath):
+        return filepath
+    filename = os.path.basename(filepath)
+    part_filepath = filepath + '.part'
+    offset = 0
+    if os.path.exists(part_filepath):
+        offset = os.path.getsize(part_filepath)
+    if os.path.isfile(data_url):
+        source = open(data_url, 'rb')
+        source.seek(offset)
+        total_size = os.path.getsize(data_url)
+    else:
+        request = urllib.request.Request(data_url)
+        if offset > 0:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+        try:
+            source = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if offset == 0 or e.code != 416:
+                raise
+            # Nothing is missing, the .part file holds the whole file
+            source = None
+            total_size = offset
+        if source is not None:
+            if offset > 0 and source.getcode() != 206:
+                # The server (or file:// URL) ignored the range
+                offset = 0
+            length = source.info().get('Content-Length')
+            total_size = offset + int(length) if length is not None else None
+    if source is not None:
+        try:
+            with open(part_filepath, 'ab' if offset > 0 else 'wb') as f:
+                count = offset
+                while True:
+                    chunk = source.read(chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    count += len(chunk)
+                    if total_size:
+                        sys.stdout.write('\r>> Downloading %s %.1f%%' %
+                                         (filename,
+                                          float(count) / total_size * 100.0))
+                        sys.stdout.flush()
+        finally:
+            source.close()
+        print()
+    if md5_hash is not None:
+        with open(part_filepath, 'rb') as f:
+            digest = _md5(f)
+        if digest != md5_hash:
+            os.remove(part_filepath)
+            raise ValueError("MD5 of {} is {}, expected {}. The partial "
+                             "download was removed."
+                             .format(filename, digest, md5_hash))
+    os.rename(part_filepath, filepath)
+    print(('Successfully downloaded {filename} '
+           '({bytes} bytes)').format(filename=filename,
+                                     bytes=os.path.getsize(filepath)))
+    return filepath
+
+
+def _archive_members(archive):
+    """Yield (name, is_dir, open function) for the files of an archive."""
+    if isinstance(archive, zipfile.ZipFile):
+        for info in archive.infolist():
+            yield (info.filename, info.filename.endswith('/'),
+                   lambda info=info: archive.open(info))
+    else:
+        for member in archive:
+            if member.isdir():
+                yield member.name, True, None
+            elif member.isfile():
+                yield (member.name, False,
+                       lambda member=member: archive.extractfile(member))
+
+
+def _md5(fileobj, out=None, chunk_size=2**20):
+    """Get the MD5 hex digest of a file object, optionally copying it."""
+    md5 = hashlib.md5()
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        md5.update(chunk)
+        if out is not None:
+            out.write(chunk)
+    return md5.hexdigest()
+
+
+def extract_archive(filepath, dest_directory, verify=False):
+    """
+    Extract a tar or zip archive incrementally.
+
+    Every member is extracted via a temporary file, so an interrupted
+    extraction leaves only complete files behind and the next call
+    continues with the missing ones. When all members are extracted, a
+    marker with the MD5 checksum of every file is written. Its name
+    contains the size and mtime of the archive, so later calls only need
+    a stat.
+
+    Parameters
+    ----------
+    filepath : str
+        Path of the archive
+    dest_directory : str
+    verify : bool, optional (default: False)
+        Compare the extracted files with the checksums of the marker and
+        extract changed or missing files again.
+
+    Returns
+    -------
+    str
+        dest_directory
+    """
+    statinfo = os.stat(filepath)
+    marker = os.path.join(dest_directory, '.{}.{}-{}.extracted'.format(
+        os.path.basename(filepath), statinfo.st_size,
+        int(statinfo.st_mtime)))
+    checksums = {}
+    if os.path.exists(marker):
+        if not verify:
+            return dest_directory
+        with open(marker) as f:
+            checksums = json.load(f)
+
+    if zipfile.is_zipfile(filepath):
+        archive = zipfile.ZipFile(filepath, 'r')
+    else:
+        archive = tarfile.open(filepath, 'r:*')
+    print('Extracting contents of "{}"...'.format(filepath))
+    dest_real = os.path.realpath(dest_directory)
+    new_checksums = {}
+    try:
+        for name, is_dir, open_member in _archive_members(archive):
+            target = os.path.realpath(os.path.join(dest_directory, name))
+            if not target.startswith(dest_real):
+                raise ValueError("Archive member '{}' is outside of '{}'"
+                                 .format(name, dest_directory))
+            if is_dir:
+                if not os.path.exists(target):
+                    os.makedirs(target)
+                continue
+            if os.path.exists(target):
+                # extracted by an earlier (interrupted) call
+                with open(target, 'rb') as f:
+                    md5 = _md5(f)
+                if name not in checksums or checksums[name] == md5:
+                    new_checksums[name] = md5
+                    continue
+            if not os.path.exists(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            source = open_member()
+            try:
+                with open(target + '.part', 'wb') as f:
+                    new_checksums[name] = _md5(source, out=f)
+            finally:
+                source.close()
+            os.rename(target + '.part', target)
+    finally:
+        archive.close()
+
+    with open(marker + '.part', 'w') as f:
+        json.dump(new_checksums, f)
+    os.rename(marker + '.part', marker)
+    return dest_directory
 
 
 def maybe_download_and_extract(dest_directory, data_url):
@@ -17,24 +220,733 @@ def maybe_download_and_extract(dest_directory, data_url):
         os.makedirs(dest_directory)
     filename = data_url.split('/')[-1]
     filepath = os.path.join(dest_directory, filename)
-    if not os.path.exists(filepath):
-        def _progress(count, block_size, total_size):
-            sys.stdout.write('\r>> Downloading %s %.1f%%' %
-                             (filename,
-                              float(count * block_size) /
-                              float(total_size) * 100.0))
-            sys.stdout.flush()
-        filepath, _ = urllib.request.urlretrieve(data_url, filepath, _progress)
-        print()
-        statinfo = os.stat(filepath)
-        print(('Successfully downloaded {filename} '
-               '({bytes} bytes)').format(filename=filename,
-                                         bytes=statinfo.st_size))
-    tarfile.open(filepath, 'r:gz').extractall(dest_directory)
-
+    download(data_url, filepath)
+    extract_archive(filepath, dest_directory)
     return dest_directory
 
 
+def npy_path(filename, key):
+    """Return the path of the .npy file in which `serialize` stores a key."""
+    return "{}-{}.npy".format(filename, key.replace('_', '-'))
+
+
+def open_npy(filename, key, shape, dtype=np.uint8):
+    """
+    Create the .npy file of `serialize` for a key as writable memmap.
+
+    This allows to fill arrays which do not fit into RAM chunk by chunk.
+    `serialize` does not write them a second time.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the pickle file (see `serialize`)
+    key : str
+    shape : tuple
+    dtype : numpy dtype, optional (default: np.uint8)
+
+    Returns
+    -------
+    numpy memmap
+    """
+    return np.lib.format.open_memmap(npy_path(filename, key), mode='w+',
+                                     dtype=dtype, shape=shape)
+
+
+def data_format_axes(native_format, data_format):
+    """
+    Get the axes which convert images from native_format to data_format.
+
+    Parameters
+    ----------
+    native_format : {'channels_first', 'channels_last'}
+        Layout in which the dataset is stored
+    data_format : {'channels_first', 'channels_last'}
+        Layout which is used for training
+
+    Returns
+    -------
+    tuple or None
+        None if no conversion is necessary
+    """
+    if native_format == data_format:
+        return None
+    if data_format == 'channels_last':
+        return (0, 2, 3, 1)
+    return (0, 3, 1, 2)
+
+
+def convert_data_format(x, native_format, data_format, out=None,
+                        chunk_size=1000, index=None):
+    """
+    Move the channel axis of images from native_format to data_format.
+
+    The conversion is done chunk by chunk, so the transposed (strided)
+    array is never copied as a whole.
+
+    Parameters
+    ----------
+    x : numpy array
+        Images in native_format
+    native_format : {'channels_first', 'channels_last'}
+    data_format : {'channels_first', 'channels_last'}
+    out : numpy array, optional
+        Array of the converted shape which gets filled, e.g. from `open_npy`
+    chunk_size : int, optional (default: 1000)
+    index : numpy array of int, optional
+        Only convert the images `x[index]`, gathered chunk by chunk
+
+    Returns
+    -------
+    numpy array
+        x itself if no conversion is necessary and neither out nor index
+        is given
+    """
+    axes = data_format_axes(native_format, data_format)
+    if axes is None:
+        if index is not None:
+            x = x[index]
+        if out is not None:
+            out[...] = x
+            return out
+        return x
+    n = len(x) if index is None else len(index)
+    if out is None:
+        out = np.empty((n,) + tuple(x.shape[i] for i in axes[1:]),
+                       dtype=x.dtype)
+    for start in range(0, n, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        if index is None:
+            out[chunk] = x[chunk].transpose(axes)
+        else:
+            out[chunk] = x[index[chunk]].transpose(axes)
+    return out
+
+
+def cached_data_format(filename, key, x, native_format, data_format):
+    """
+    Get the array `key` of the cache `filename` in data_format.
+
+    The converted array is stored next to the cache on the first call
+    (see `npy_path`) and memory-mapped on later calls, so the layout is
+    only converted once.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the pickle file (see `serialize`)
+    key : str
+    x : numpy array
+        The array `key` of the cache in native_format
+    native_format : {'channels_first', 'channels_last'}
+    data_format : {'channels_first', 'channels_last'}
+
+    Returns
+    -------
+    numpy array
+        x itself if no conversion is necessary
+    """
+    axes = data_format_axes(native_format, data_format)
+    if axes is None:
+        return x
+    fpath = npy_path(filename, "{}_{}".format(key, data_format))
+    stale = (os.path.isfile(fpath) and isinstance(x, np.memmap) and
+             x.filename is not None and
+             os.path.getmtime(x.filename) > os.path.getmtime(fpath))
+    if stale or not os.path.isfile(fpath):
+        tmp_fpath = "{}.{}.tmp.npy".format(fpath[:-len(".npy")], os.getpid())
+        out = np.lib.format.open_memmap(tmp_fpath, mode='w+', dtype=x.dtype,
+                                        shape=tuple(x.shape[i] for i in axes))
+        convert_data_format(x, native_format, data_format, out=out)
+        out.flush()
+        del out
+        os.rename(tmp_fpath, fpath)
+    return np.load(fpath, mmap_mode='c')
+
+
+def serialize(filename, data):
+    """
+    Store a dataset dict as a pickle with all arrays in separate .npy files.
+
+    Every numpy array in `data` is written to `{filename}-{key}.npy`. The
+    pickle only stores the name of that file, so `deserialize` can
+    memory-map the arrays instead of reading them into RAM.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the pickle file. The cache parameters (e.g. image size) are
+        expected to be encoded in it.
+    data : dict
+    """
+    meta = {}
+    for key, value in data.items():
+        if isinstance(value, np.ndarray):
+            npy_fname = npy_path(filename, key)
+            if (isinstance(value, np.memmap) and value.filename is not None and
+                    os.path.abspath(value.filename) ==
+                    os.path.abspath(npy_fname)):
+                # filled in place (see open_npy)
+                value.flush()
+            else:
+                np.save(npy_fname, value)
+            meta[key] = os.path.basename(npy_fname)
+        else:
+            meta[key] = value
+    # Write the pickle last: it only exists if all arrays were written.
+    with open(filename, 'wb') as f:
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def deserialize(filename, mmap_mode='c'):
+    """
+    Load a dataset dict which was stored with `serialize`.
+
+    Pickles which still contain the arrays inline are converted to the .npy
+    layout on the first call.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the pickle file.
+    mmap_mode : {None, 'r', 'r+', 'c'}, optional (default: 'c')
+        Passed to `np.load`. With the default copy-on-write mode nothing is
+        read before it is accessed and in-place changes (e.g. relabeling)
+        never reach the cache files.
+
+    Returns
+    -------
+    dict
+    """
+    with open(filename, 'rb') as f:
+        data = pickle.load(f)
+    if any(isinstance(value, np.ndarray) for value in data.values()):
+        serialize(filename, data)
+        return deserialize(filename, mmap_mode=mmap_mode)
+    dirname = os.path.dirname(filename)
+    for key, value in data.items():
+        if isinstance(value, string_types) and value.endswith('.npy'):
+            data[key] = np.load(os.path.join(dirname, value),
+                                mmap_mode=mmap_mode)
+    return data
+
+
+def read_images(fnames, read_image, shape, n_jobs=None, out=None):
+    """
+    Decode images with a pool of worker processes.
+
+    Parameters
+    ----------
+    fnames : list of str
+    read_image : callable
+        Maps a filename to a uint8 array of shape `shape`. It is sent to the
+        worker processes, so it has to be a module-level function or a
+        `functools.partial` of one.
+    shape : tuple
+        Shape of a single decoded image.
+    n_jobs : int, optional (default: number of CPUs)
+        Number of worker processes. With `n_jobs=1` no pool is started.
+    out : numpy array, optional
+        Preallocated array of shape `(len(fnames),) + shape` to write into.
+
+    Returns
+    -------
+    numpy array
+        The decoded images in the order of `fnames`.
+    """
+    if out is None:
+        out = np.zeros((len(fnames),) + tuple(shape), dtype=np.uint8)
+    for i, img in enumerate(parallel_map(read_image, fnames, n_jobs=n_jobs)):
+        out[i] = img
+    return out
+
+
+def parallel_map(func, iterable, n_jobs=None, chunksize=32):
+    """
+    Apply func to every item with a pool of worker processes.
+
+    Parameters
+    ----------
+    func : callable
+        A module-level function or a `functools.partial` of one
+    iterable : iterable
+    n_jobs : int, optional (default: number of CPUs)
+        Number of worker processes. With `n_jobs=1` no pool is started.
+    chunksize : int, optional (default: 32)
+        Number of items which are sent to a worker at once
+
+    Yields
+    ------
+    The results in the order of iterable.
+    """
+    if n_jobs == 1:
+        for item in iterable:
+            yield func(item)
+        return
+    pool = multiprocessing.Pool(n_jobs)
+    finished = False
+    try:
+        # imap keeps the order of the items, so results are reproducible
+        for result in pool.imap(func, iterable, chunksize=chunksize):
+            yield result
+        finished = True
+    finally:
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+
+def get_split_indices(name, y, test_sizes, random_state=42, stratify=True):
+    """
+    Split the indices of a dataset and cache the result on disk.
+
+    The same (dataset, labels, seed, fractions) always gives the same
+    split, no matter which tool asks for it. Only index arrays are
+    returned, so the data does not get copied.
+
+    Parameters
+    ----------
+    name : str
+        Name of the dataset (part of the cache file name)
+    y : numpy array
+        Labels of all examples
+    test_sizes : list of float
+        Fractions which get split off one after another, e.g. [0.33, 0.10]
+        first splits off 33% of all examples and then 10% of the rest.
+    random_state : int, optional (default: 42)
+    stratify : bool, optional (default: True)
+        Stratify each split by y.
+
+    Returns
+    -------
+    list of numpy arrays
+        The remaining indices, followed by the indices of each split.
+    """
+    y = np.ascontiguousarray(y)
+    checksum = hashlib.md5(y.tobytes()).hexdigest()[:8]
+    fname = "{}-{}-{}-{}-{}.npz".format(name, len(y), checksum, random_state,
+                                        "-".join(str(el) for el in test_sizes))
+    if not stratify:
+        fname = fname.replace(".npz", "-unstratified.npz")
+    fpath = os.path.join(_split_dir, fname)
+    if os.path.isfile(fpath):
+        with np.load(fpath) as splits:
+            return [splits['arr_{}'.format(i)]
+                    for i in range(len(test_sizes) + 1)]
+
+    rest = np.arange(len(y))
+    splits = []
+    for test_size in test_sizes:
+        rest, split = train_test_split(rest,
+                                       test_size=test_size,
+                                       random_state=random_state,
+                                       stratify=y[rest] if stratify else None)
+        splits.append(split)
+    splits = [rest] + splits
+
+    if not os.path.exists(_split_dir):
+        os.makedirs(_split_dir)
+    # write to a temporary file, so that a cache file is always complete
+    tmp_fpath = "{}.{}.tmp.npz".format(fpath[:-len(".npz")], os.getpid())
+    np.savez(tmp_fpath, *splits)
+    os.rename(tmp_fpath, fpath)
+    return splits
+
+
+def _records_index_path(path):
+    return "{}-index.npz".format(path)
+
+
+def _records_shard_path(path, shard):
+    return "{}-{:05d}.npy".format(path, shard)
+
+
+def has_records(path):
+    """Check if the record store at path was written completely."""
+    return os.path.isfile(_records_index_path(path))
+
+
+def write_records(path, fnames, read_image, shape, labels=None,
+                  shard_size=10000, n_jobs=None):
+    """
+    Decode images into a sharded record store (see `RecordStore`).
+
+    Each shard is a .npy file which gets filled in place by `read_images`,
+    so the decoded dataset is never in RAM.
+
+    Parameters
+    ----------
+    path : str
+        Prefix of the store. The shards are `{path}-00000.npy`, ... and the
+        index is `{path}-index.npz`.
+    fnames : list of str
+    read_image : callable
+        See `read_images`
+    shape : tuple
+        Shape of one record
+    labels : numpy array, optional
+    shard_size : int, optional (default: 10000)
+        Number of records per shard
+    n_jobs : int, optional (default: number of CPUs)
+
+    Returns
+    -------
+    RecordStore
+    """
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    n = len(fnames)
+    for shard, start in enumerate(range(0, n, shard_size)):
+        records = np.lib.format.open_memmap(
+            _records_shard_path(path, shard), mode='w+', dtype=np.uint8,
+            shape=(min(shard_size, n - start),) + tuple(shape))
+        read_images(fnames[start:start + shard_size], read_image, shape,
+                    n_jobs=n_jobs, out=records)
+        records.flush()
+        del records
+    index = {'n': n, 'shard_size': shard_size, 'shape': tuple(shape),
+             'fnames': np.array(fnames)}
+    if labels is not None:
+        index['labels'] = np.asarray(labels)
+    # Write the index last: it only exists if all shards were written.
+    index_path = _records_index_path(path)
+    tmp_path = "{}.{}.tmp.npz".format(index_path[:-len(".npz")], os.getpid())
+    np.savez(tmp_path, **index)
+    os.rename(tmp_path, index_path)
+    return RecordStore(path)
+
+
+class RecordStore(object):
+    """
+    Read-only array of fixed-size uint8 records in memory-mapped shards.
+
+    Records are addressed like the rows of a numpy array (index, slice,
+    index array or boolean mask, optionally followed by indices into the
+    records). Only the requested records are read, so shuffled minibatches
+    can be served without having the dataset in RAM and processes which
+    read the same store share the OS page cache.
+
+    Parameters
+    ----------
+    path : str
+        Prefix of the store (see `write_records`)
+    axes : tuple, optional
+        Transpose every batch which is read, e.g. `data_format_axes(...)`
+
+    Attributes
+    ----------
+    shape : tuple
+    dtype : numpy dtype
+    labels : numpy array or None
+    fnames : list of str
+        Files the records were decoded from
+    """
+
+    def __init__(self, path, axes=None):
+        with np.load(_records_index_path(path)) as index:
+            n = int(index['n'])
+            shard_size = int(index['shard_size'])
+            self._record_shape = tuple(int(el) for el in index['shape'])
+            self.fnames = index['fnames'].tolist()
+            if 'labels' in index.files:
+                self.labels = index['labels']
+            else:
+                self.labels = None
+        n_shards = (n + shard_size - 1) // shard_size
+        self._axes = axes
+        self.dtype = np.dtype(np.uint8)
+        self._set_shards([np.load(_records_shard_path(path, shard),
+                                  mmap_mode='r')
+                          for shard in range(n_shards)])
+
+    def _set_shards(self, shards):
+        """Set the memory-mapped shards and everything derived from them."""
+        self._shards = shards
+        self._starts = np.cumsum([0] + [len(shard) for shard in shards])
+        self._n = int(self._starts[-1])
+        self._native_shape = (self._n,) + self._record_shape
+        if self._axes is None:
+            self.shape = self._native_shape
+        else:
+            self.shape = tuple(self._native_shape[i] for i in self._axes)
+
+    def concatenate(self, *stores):
+        """
+        Get a store of these records followed by the records of `stores`.
+
+        Nothing is read or copied; the result uses the shards of all
+        stores. The stores need the same record shape and `axes`.
+        """
+        for store in stores:
+            if (store._record_shape != self._record_shape or
+                    store._axes != self._axes):
+                raise ValueError("Only stores with the same record shape and "
+                                 "axes can be concatenated.")
+        stores = (self,) + stores
+        result = copy.copy(self)
+        result.fnames = [fname for store in stores for fname in store.fnames]
+        if any(store.labels is None for store in stores):
+            result.labels = None
+        else:
+            result.labels = np.concatenate([store.labels for store in stores])
+        result._set_shards([shard for store in stores
+                            for shard in store._shards])
+        return result
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def take(self, indices, axis=0, out=None, mode='raise'):
+        """Read the records at indices (see `numpy.take`)."""
+        if axis != 0:
+            raise ValueError("Records can only be taken along axis 0.")
+        indices = np.asarray(indices, dtype=np.int64)
+        if mode == 'clip':
+            indices = np.clip(indices, 0, self._n - 1)
+        elif mode == 'wrap':
+            indices = indices % self._n
+        else:
+            indices = np.where(indices < 0, indices + self._n, indices)
+            if indices.size and (indices.min() < 0 or
+                                 indices.max() >= self._n):
+                raise IndexError("Record index out of range for {} records."
+                                 .format(self._n))
+        if out is None:
+            out = np.empty(indices.shape + self.shape[1:], dtype=self.dtype)
+        if self._axes is None:
+            records = out
+        else:
+            records = np.empty(indices.shape + self._native_shape[1:],
+                               dtype=self.dtype)
+        shard_ids = np.searchsorted(self._starts, indices, side='right') - 1
+        offsets = indices - self._starts[shard_ids]
+        for shard in np.unique(shard_ids):
+            mask = shard_ids == shard
+            records[mask] = self._shards[shard][offsets[mask]]
+        if self._axes is not None:
+            # Only the batch is converted to the training layout
+            out[...] = records.transpose(self._axes)
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            if len(key) == 0 or key[0] is Ellipsis:
+                return self[:][key]
+            first, rest = key[0], key[1:]
+            if isinstance(first, integer_types + (np.integer, slice)):
+                records = self[first]
+                if isinstance(first, slice):
+                    rest = (slice(None),) + rest
+                return records[rest]
+            # Read every record once; the index arrays are broadcast
+            # against each other as by numpy
+            first = self._as_indices(first)
+            unique, inverse = np.unique(first, return_inverse=True)
+            inverse = inverse.reshape(first.shape)
+            return self.take(unique)[(inverse,) + rest]
+        if isinstance(key, integer_types + (np.integer,)):
+            return self.take([key])[0]
+        if isinstance(key, slice):
+            return self.take(np.arange(*key.indices(self._n)))
+        return self.take(self._as_indices(key))
+
+    def _as_indices(self, key):
+        """Get the record indices of an index array or boolean mask."""
+        key = np.asarray(key)
+        if key.dtype == bool:
+            if key.shape != (self._n,):
+                raise IndexError("Boolean mask of shape {} does not match "
+                                 "{} records.".format(key.shape, self._n))
+            key = np.flatnonzero(key)
+        return key
+
+    def __array__(self, dtype=None):
+        records = self[:]
+        if dtype is not None:
+            records = records.astype(dtype)
+        return records
+
+
+_statistics = {}
+
+
+class RunningStatistics(object):
+    """
+    Streaming mean, standard deviation and covariance of examples.
+
+    Chunks of examples are merged with the parallel variant of Welford's
+    algorithm (Chan et al.), so the data never has to be in memory at once.
+
+    Parameters
+    ----------
+    channel_axis : int, optional (default: -1)
+        Axis of the channels within one example. Used for the per-channel
+        statistics.
+    covariance : bool, optional (default: False)
+        Also track the covariance of the flattened examples (as needed for
+        ZCA whitening). This needs a d x d float64 matrix for d features.
+    """
+
+    def __init__(self, channel_axis=-1, covariance=False):
+        self.channel_axis = channel_axis
+        self.track_covariance = covariance
+        self.n = 0
+        self._mean = None
+        self._m2 = None
+        self._comoment = None
+
+    def update(self, chunk):
+        """Add a chunk of examples (along the first axis)."""
+        chunk = np.array(chunk, dtype=np.float64)
+        n_chunk = len(chunk)
+        if n_chunk == 0:
+            return
+        if self._mean is None:
+            self._mean = np.zeros(chunk.shape[1:], dtype=np.float64)
+            self._m2 = np.zeros(chunk.shape[1:], dtype=np.float64)
+            if self.track_covariance:
+                d = self._mean.size
+                self._comoment = np.zeros((d, d), dtype=np.float64)
+        mean_chunk = chunk.mean(axis=0)
+        chunk -= mean_chunk
+        delta = mean_chunk - self._mean
+        n_new = self.n + n_chunk
+        factor = float(self.n) * n_chunk / n_new
+        self._mean += delta * (float(n_chunk) / n_new)
+        self._m2 += (chunk ** 2).sum(axis=0) + delta ** 2 * factor
+        if self.track_covariance:
+            flat = chunk.reshape((n_chunk, -1))
+            flat_delta = delta.reshape(-1)
+            self._comoment += np.dot(flat.T, flat)
+            self._comoment += np.outer(flat_delta, flat_delta) * factor
+        self.n = n_new
+
+    @property
+    def mean(self):
+        """Mean of each feature (shape of one example)."""
+        return self._mean
+
+    @property
+    def std(self):
+        """Standard deviation of each feature (shape of one example)."""
+        return np.sqrt(self._m2 / max(self.n, 1))
+
+    @property
+    def channel_mean(self):
+        """Mean of each channel over all examples and positions."""
+        axes = self._other_axes()
+        return self._mean.mean(axis=axes)
+
+    @property
+    def channel_std(self):
+        """Standard deviation of each channel over examples and positions."""
+        axes = self._other_axes()
+        channel_mean = self._mean.mean(axis=axes, keepdims=True)
+        m2 = self._m2 + self.n * (self._mean - channel_mean) ** 2
+        return np.sqrt(m2.mean(axis=axes) / max(self.n, 1))
+
+    @property
+    def covariance(self):
+        """Covariance matrix of the flattened examples (or None)."""
+        if self._comoment is None:
+            return None
+        return self._comoment / max(self.n, 1)
+
+    def _other_axes(self):
+        channel_axis = self.channel_axis % self._mean.ndim
+        return tuple(i for i in range(self._mean.ndim) if i != channel_axis)
+
+    def save(self, path):
+        """
+        Store the statistics as .npz file.
+
+        The file can be passed to `ImageDataGenerator.fit_from_statistics`
+        (after `np.load`).
+        """
+        arrays = {'n': self.n,
+                  'mean': self.mean,
+                  'std': self.std,
+                  'channel_mean': self.channel_mean,
+                  'channel_std': self.channel_std}
+        if self.track_covariance:
+            arrays['covariance'] = self.covariance
+        np.savez(path, **arrays)
+
+
+def compute_statistics(x, chunk_size=1000):
+    """
+    Compute the per-pixel mean and standard deviation of x in one pass.
+
+    The data is read in chunks of `chunk_size` examples, so `x` can be a
+    memory-mapped array which does not fit into RAM.
+
+    Parameters
+    ----------
+    x : numpy array
+        Examples along the first axis
+    chunk_size : int
+
+    Returns
+    -------
+    tuple
+        (mean, std) as float32 arrays of shape `x.shape[1:]`
+    """
+    statistics = RunningStatistics()
+    for start in range(0, len(x), chunk_size):
+        statistics.update(x[start:start + chunk_size])
+    return (statistics.mean.astype(np.float32),
+            statistics.std.astype(np.float32))
+
+
+def _std_path(mean_path):
+    return mean_path.replace("-mean.npy", "-std.npy")
+
+
+def load_statistics(mean_path, x=None):
+    """
+    Get the mean image and standard deviation of a dataset.
+
+    The statistics are loaded only once per process and kept as read-only
+    float32 arrays which broadcast against a batch of images.
+
+    Parameters
+    ----------
+    mean_path : str
+        Path to a `*-mean.npy` file. The standard deviation is stored as
+        `*-std.npy` next to it. As the file names of datasets with
+        different resolutions contain the resolution, there is one cache
+        entry per resolution.
+    x : numpy array, optional
+        Training data. If the statistics files do not exist, they are
+        computed from `x` with `compute_statistics` and stored.
+
+    Returns
+    -------
+    tuple
+        (mean, std). `std` is None if only the mean file exists.
+    """
+    if mean_path not in _statistics:
+        if not os.path.isfile(mean_path) and x is not None:
+            mean, std = compute_statistics(x)
+            np.save(mean_path, mean)
+            np.save(_std_path(mean_path), std)
+        mean = np.load(mean_path).astype(np.float32)
+        std = None
+        if os.path.isfile(_std_path(mean_path)):
+            std = np.load(_std_path(mean_path)).astype(np.float32)
+            std.setflags(write=False)
+        mean.setflags(write=False)
+        _statistics[mean_path] = (mean, std)
+    return _statistics[mean_path]
+
+
 class DataSet(object):
     """DataSet from tensorflow.contrib.learn.python.learn.datasets.mnist."""
 
@@ -100,3 +1012,91 @@ class DataSet(object):
             assert batch_size <= self._num_examples
         end = self._index_in_epoch
         return self._images[start:end], self._labels[start:end]
+
+    def batch(self, start, end):
+        """Return the examples `start` to `end` in storage order."""
+        return self._images[start:end], self._labels[start:end]
+
+
+class IndexedDataSet(DataSet):
+    """
+    DataSet which keeps uint8 images and only shuffles an index permutation.
+
+    Batches are gathered (and rescaled to `[0, 1]` for `float32`) into a
+    ring of `n_buffers` preallocated buffers. Neither a float copy of the
+    data nor a copy per epoch is made. A returned batch is overwritten by
+    the `n_buffers`-th following call of `next_batch`. `batch` has a
+    buffer of its own, which the following call of `batch` overwrites, so
+    the data set can be evaluated while another thread calls `next_batch`.
+    """
+
+    def __init__(self,
+                 images,
+                 labels,
+                 one_hot=False,
+                 dtype=dtypes.float32,
+                 n_buffers=1):
+        dtype = dtypes.as_dtype(dtype).base_dtype
+        if dtype not in (dtypes.uint8, dtypes.float32):
+            raise TypeError(('Invalid image dtype %r, expected uint8 or '
+                             'float32') % dtype)
+        super(IndexedDataSet, self).__init__(images, labels,
+                                             one_hot=one_hot,
+                                             dtype=dtypes.uint8)
+        self._rescale = dtype == dtypes.float32
+        self._perm = np.arange(self._num_examples)
+        # Rings of next_batch and batch: [n_buffers, buffers, index]
+        self._rings = {'next_batch': [n_buffers, [], 0],
+                       'batch': [1, [], 0]}
+
+    def _get_buffers(self, batch_size, ring='next_batch'):
+        n_buffers, buffers, index = self._rings[ring]
+        if len(buffers) < n_buffers:
+            images_shape = (batch_size,) + self._images.shape[1:]
+            labels_shape = (batch_size,) + self._labels.shape[1:]
+            raw = np.empty(images_shape, dtype=self._images.dtype)
+            if self._rescale:
+                images = np.empty(images_shape, dtype=np.float32)
+            else:
+                images = raw
+            labels = np.empty(labels_shape, dtype=self._labels.dtype)
+            buffers.append((raw, images, labels))
+        self._rings[ring][2] = (index + 1) % n_buffers
+        if len(buffers[index][0]) < batch_size:
+            # Grow the buffer (only happens for a bigger batch_size)
+            self._rings[ring] = [n_buffers, [], 0]
+            return self._get_buffers(batch_size, ring)
+        return buffers[index]
+
+    def _gather(self, index, ring='next_batch'):
+        raw, images, labels = self._get_buffers(len(index), ring)
+        n = len(index)
+        raw, images, labels = raw[:n], images[:n], labels[:n]
+        np.take(self._images, index, axis=0, out=raw)
+        np.take(self._labels, index, axis=0, out=labels)
+        if self._rescale:
+            # Convert from [0, 255] -> [0.0, 1.0].
+            images[...] = raw
+            images *= 1.0 / 255.0
+        return images, labels
+
+    def next_batch(self, batch_size):
+        """Return the next `batch_size` examples from this data set."""
+        start = self._index_in_epoch
+        self._index_in_epoch += batch_size
+        if self._index_in_epoch > self._num_examples:
+            # Finished epoch
+            self._epochs_completed += 1
+            # Shuffling the index gives the same order as DataSet
+            np.random.shuffle(self._perm)
+            # Start next epoch
+            start = 0
+            self._index_in_epoch = batch_size
+            assert batch_size <= self._num_examples
+        end = self._index_in_epoch
+        return self._gather(self._perm[start:end])
+
+    def batch(self, start, end):
+        """Return the examples `start` to `end` in storage order."""
+        return self._gather(np.arange(start, min(end, self._num_examples)),
+                            ring='batch')
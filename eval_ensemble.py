@@ -9,23 +9,16 @@ import logging
 import os
 import sys
 
-from keras.models import load_model
-from keras.utils import np_utils
-
-
 from natsort import natsorted
 
 import numpy as np
 
-from sklearn.model_selection import train_test_split
-
 import yaml
 
-train_keras = imp.load_source('train_keras', "train/train_keras.py")
-
-from train_keras import get_level, flatten_completely, filter_by_class
-from train_keras import update_labels
+from run_training import LazyModule, load_modules
 from create_cm import run_model_prediction
+train_keras = LazyModule('train_keras', "train/train_keras.py")
+
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
                     level=logging.DEBUG,
                     stream=sys.stdout)
@@ -92,7 +85,8 @@ def main(ensemble_fname, evaluate_training_data):
         artifacts['config'] = config
 
     sys.path.insert(1, os.path.dirname(config['dataset']['script_path']))
-    data_module = imp.load_source('data', config['dataset']['script_path'])
+    data_module = load_modules(config)['data']
+    from utils import get_split_indices
 
     # Load data
     data = data_module.load_data(config)
@@ -101,33 +95,36 @@ def main(ensemble_fname, evaluate_training_data):
     y_train = data['y_train']
     y_test = data['y_test']
 
-    X_train = data_module.preprocess(X_train)
-    X_test = data_module.preprocess(X_test)
-
     # load hierarchy, if present
     if 'hierarchy_path' in config['dataset']:
         with open(config['dataset']['hierarchy_path']) as data_file:
             hierarchy = json.load(data_file)
         if 'subset' in config['dataset']:
-            remaining_cls = get_level(hierarchy, config['dataset']['subset'])
+            remaining_cls = train_keras.get_level(hierarchy,
+                                                  config['dataset']['subset'])
             logging.info("Remaining classes: {}".format(remaining_cls))
             # Only do this if coarse is False:
-            remaining_cls = flatten_completely(remaining_cls)
+            remaining_cls = train_keras.flatten_completely(remaining_cls)
             data_module.n_classes = len(remaining_cls)
-            X_train, y_train = filter_by_class(X_train, y_train, remaining_cls)
-            X_test, y_test = filter_by_class(X_test, y_test, remaining_cls)
-            old_cli2new_cli = {}
-            for new_cli, old_cli in enumerate(remaining_cls):
-                old_cli2new_cli[old_cli] = new_cli
-            y_train = update_labels(y_train, old_cli2new_cli)
-            y_test = update_labels(y_test, old_cli2new_cli)
+            X_train, y_train = train_keras.filter_by_class(X_train, y_train,
+                                                           remaining_cls)
+            X_test, y_test = train_keras.filter_by_class(X_test, y_test,
+                                                         remaining_cls)
+            old_cli2new_cli = train_keras.get_old_cli2new_cli(remaining_cls)
+            y_train = train_keras.update_labels(y_train, old_cli2new_cli)
+            y_test = train_keras.update_labels(y_test, old_cli2new_cli)
 
     n_classes = data_module.n_classes
     logging.info("n_classes={}".format(n_classes))
 
-    X_train, X_val, y_train, y_val = train_test_split(X_train, y_train,
-                                                      test_size=0.10,
-                                                      random_state=42)
+    # Only the indices get split, so the data is preprocessed (copied) once
+    dataset_name = os.path.splitext(
+        os.path.basename(config['dataset']['script_path']))[0]
+    i_train, _ = get_split_indices(dataset_name + '-ensemble', y_train,
+                                   [0.10], stratify=False)
+    X_train = data_module.preprocess(X_train[i_train])
+    y_train = y_train[i_train]
+    X_test = data_module.preprocess(X_test)
 
     if evaluate_training_data:
         X_eval = X_train
@@ -143,6 +140,7 @@ def main(ensemble_fname, evaluate_training_data):
                         config['model']['script_path'])
         from model_module import *
 
+    from keras.models import load_model
     model_names = natsorted(config["models"])
     print("Ensemble of {} models ({})".format(len(model_names), model_names))
     models = []
@@ -192,6 +190,7 @@ def main(ensemble_fname, evaluate_training_data):
                                                             bitstring))
             artifacts['ensemble']['complete_ensemble_acc'] = acc * 100
 
+    from keras.utils import np_utils
     Y_eval = np_utils.to_categorical(y_eval, n_classes)
     smoothed_lables = (y_val_pred + Y_eval) / 2
     np.save("smoothed_lables", smoothed_lables)
@@ -9,12 +9,10 @@ import yaml
 import random
 import numpy as np
 import time
-from keras.models import load_model
 import logging
 import datetime
 import glob
-train_keras = imp.load_source('train_keras', "train/train_keras.py")
-from run_training import make_paths_absolute
+from run_training import make_paths_absolute, load_modules
 
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
                     level=logging.DEBUG,
@@ -49,6 +47,7 @@ def inference_timing(data_module, config, model_path, batch_sizes):
     imp.load_source('model_module',
                     experiment_meta['model']['script_path'])
     from model_module import *
+    from keras.models import load_model
     model = load_model(model_path)
 
     # The data, shuffled and split between train and test sets:
@@ -115,7 +114,5 @@ if __name__ == '__main__':
                                           experiment_meta)
     pp = pprint.PrettyPrinter(indent=4)
     pp.pprint(experiment_meta)
-    dpath = experiment_meta['dataset']['script_path']
-    sys.path.insert(1, os.path.dirname(dpath))
-    data = imp.load_source('data', experiment_meta['dataset']['script_path'])
+    data = load_modules(experiment_meta)['data']
     inference_timing(data, experiment_meta, args.model_fname, [1, 128])
@@ -4,9 +4,8 @@ from cleverhans.attacks import fgsm
 from keras.models import load_model
 import scipy.misc
 import yaml
-from run_training import make_paths_absolute
+from run_training import make_paths_absolute, load_modules
 import os
-import imp
 import sys
 import glob
 import logging
@@ -59,9 +58,7 @@ if __name__ == "__main__":
     pp.pprint(config)
 
     # Load data module
-    dpath = config['dataset']['script_path']
-    sys.path.insert(1, os.path.dirname(dpath))
-    data = imp.load_source('data', config['dataset']['script_path'])
+    data = load_modules(config)['data']
 
     # Load model
     if args.model_path is not None:
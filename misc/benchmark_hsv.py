@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the HSV augmentation of the adjusted preprocessing/image.py.
+
+Compares the float32 in-place kernel with the former matplotlib
+implementation (rgb_to_hsv / hsv_to_rgb) in images per second. Both use
+the same random parameters, the maximal absolute difference is printed.
+"""
+
+from __future__ import print_function
+
+import time
+import numpy as np
+from keras.preprocessing.image import hsv_augmentation
+
+
+def hsv_augmentation_matplotlib(x, hue_shift,
+                                saturation_scale, saturation_shift,
+                                value_scale, value_shift):
+    """The former implementation of `hsv_augmentation` (channels last)."""
+    from matplotlib.colors import rgb_to_hsv, hsv_to_rgb
+    nexamples = x.shape[0]
+    hsv = rgb_to_hsv(x)
+    saturation_scale, value_scale = float(saturation_scale), float(value_scale)
+    shape = (nexamples, 1, 1)
+    hsv[..., 0] += np.random.uniform(low=-hue_shift, high=hue_shift,
+                                     size=nexamples).reshape(shape)
+    hsv[..., 1] *= np.random.uniform(low=1 / (1 + saturation_scale),
+                                     high=saturation_scale,
+                                     size=nexamples).reshape(shape)
+    hsv[..., 1] += np.random.uniform(low=-saturation_shift,
+                                     high=saturation_shift,
+                                     size=nexamples).reshape(shape)
+    hsv[..., 2] *= np.random.uniform(low=1 / (1 + value_scale),
+                                     high=1 + value_scale,
+                                     size=nexamples).reshape(shape)
+    hsv[..., 2] += np.random.uniform(low=-value_shift, high=value_shift,
+                                     size=nexamples).reshape(shape)
+    return hsv_to_rgb(np.clip(hsv, 0, 1))
+
+
+def images_per_second(augment, x, parameters, repeats):
+    """Get the throughput of augment, the data is copied outside of it."""
+    batches = [x.copy() for _ in range(repeats)]
+    t0 = time.time()
+    for batch in batches:
+        augment(batch, *parameters)
+    return repeats * len(x) / (time.time() - t0)
+
+
+def main(batch_size, size, repeats, parameters):
+    """Print the throughput of both implementations."""
+    x = np.random.RandomState(0).rand(batch_size, size, size, 3)
+    x = x.astype(np.float32)
+
+    np.random.seed(0)
+    expected = hsv_augmentation_matplotlib(x.copy(), *parameters)
+    np.random.seed(0)
+    result = hsv_augmentation(x.copy(), *parameters, dim_ordering='tf')
+    print("Max. absolute difference: {:0.2e}"
+          .format(np.abs(result - expected).max()))
+
+    for name, augment in [('matplotlib', hsv_augmentation_matplotlib),
+                          ('float32 in-place', hsv_augmentation)]:
+        speed = images_per_second(augment, x, parameters, repeats)
+        print("{:>16}: {:10.1f} images/s".format(name, speed))
+
+
+def get_parser():
+    """Get parser object for script benchmark_hsv.py."""
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--batch_size",
+                        dest="batch_size",
+                        type=int,
+                        default=64,
+                        help="number of images per batch")
+    parser.add_argument("--size",
+                        dest="size",
+                        type=int,
+                        default=32,
+                        help="width and height of the images")
+    parser.add_argument("--repeats",
+                        dest="repeats",
+                        type=int,
+                        default=50,
+                        help="number of batches which get augmented")
+    parser.add_argument("--parameters",
+                        dest="parameters",
+                        type=float,
+                        nargs=5,
+                        default=[0.1, 1.2, 0.1, 0.2, 0.1],
+                        help="hue shift, saturation scale, saturation "
+                             "shift, value scale, value shift")
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    main(args.batch_size, args.size, args.repeats, args.parameters)
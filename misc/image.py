@@ -5,13 +5,17 @@ new preprocessing methods, etc...
 from __future__ import absolute_import
 from __future__ import print_function
 
+import ctypes
+import multiprocessing
 import numpy as np
 import re
 from scipy import linalg
 import scipy.ndimage as ndi
+from six.moves import queue
 from six.moves import range
 import os
 import threading
+import traceback
 import warnings
 
 from .. import backend as K
@@ -169,6 +173,9 @@ def transform_matrix_offset_center(matrix, x, y):
     o_y = float(y) / 2 + 0.5
     offset_matrix = np.array([[1, 0, o_x], [0, 1, o_y], [0, 0, 1]])
     reset_matrix = np.array([[1, 0, -o_x], [0, 1, -o_y], [0, 0, 1]])
+    if matrix.ndim == 3:
+        # a stack of matrices (see `random_transform_batch`)
+        return np.matmul(np.matmul(offset_matrix, matrix), reset_matrix)
     transform_matrix = np.dot(np.dot(offset_matrix, matrix), reset_matrix)
     return transform_matrix
 
@@ -208,6 +215,132 @@ def apply_transform(x,
     return x
 
 
+def apply_transform_batch(x,
+                          transform_matrices,
+                          channel_axis=3,
+                          fill_mode='nearest',
+                          cval=0.):
+    """Apply one image transformation per image to a batch.
+
+    Gives the same result as `apply_transform` on every image (nearest
+    neighbour interpolation of `ndi.interpolation.affine_transform` with
+    `order=0`), but the whole batch is resampled with one gather.
+
+    # Arguments
+        x: 4D numpy array, batch of images.
+        transform_matrices: Numpy array of shape `(n, 3, 3)`, one matrix
+            per image as for `apply_transform`.
+        channel_axis: Index of axis for channels in the input tensor.
+        fill_mode: Points outside the boundaries of the input
+            are filled according to the given mode
+            (one of `{'constant', 'nearest'}`).
+        cval: Value used for points outside the boundaries
+            of the input if `mode='constant'`.
+
+    # Returns
+        The transformed version of the input.
+    """
+    if fill_mode not in {'constant', 'nearest'}:
+        raise ValueError('Batches can only be transformed with fill_mode '
+                         '"constant" or "nearest". Received arg: ', fill_mode)
+    x = np.rollaxis(x, channel_axis, 4)
+    n, h, w = x.shape[:3]
+    rows = np.arange(h, dtype=np.float64).reshape(1, h, 1)
+    cols = np.arange(w, dtype=np.float64).reshape(1, 1, w)
+    m = transform_matrices.reshape(n, 3, 3, 1, 1)
+    # Input coordinates of every output pixel, summed in the same order as
+    # in affine_transform, so the rounding is identical
+    in_rows = m[:, 0, 2] + m[:, 0, 0] * rows + m[:, 0, 1] * cols
+    in_cols = m[:, 1, 2] + m[:, 1, 0] * rows + m[:, 1, 1] * cols
+    i_rows = np.clip(np.floor(in_rows + 0.5), 0, h - 1).astype(np.intp)
+    i_cols = np.clip(np.floor(in_cols + 0.5), 0, w - 1).astype(np.intp)
+    x = x[np.arange(n).reshape(n, 1, 1), i_rows, i_cols]
+    if fill_mode == 'constant':
+        outside = ((in_rows < 0) | (in_rows > h - 1) |
+                   (in_cols < 0) | (in_cols > w - 1))
+        x[outside] = cval
+    x = np.rollaxis(x, 3, channel_axis)
+    return x
+
+
+def apply_translation_batch(x,
+                            transform_matrices,
+                            row_axis=1,
+                            col_axis=2,
+                            flip_rows=None,
+                            flip_cols=None):
+    """Apply translations to a batch as integer crops.
+
+    If the matrices only translate, `apply_transform_batch` with
+    `fill_mode='nearest'` shifts every image by a whole number of pixels
+    and repeats the border. This is done here by cropping the edge-padded
+    batch, without any interpolation. The rounding of the coordinates is
+    checked, so the result is bit-exact.
+
+    # Arguments
+        x: 4D numpy array, batch of images.
+        transform_matrices: Numpy array of shape `(n, 3, 3)`.
+        row_axis: Index of axis for rows in the input tensor.
+        col_axis: Index of axis for columns in the input tensor.
+        flip_rows: Optional boolean array, flip these images vertically.
+        flip_cols: Optional boolean array, flip these images horizontally.
+
+    # Returns
+        The transformed version of the input, or None if the matrices
+        are not integer translations.
+    """
+    n = x.shape[0]
+    h, w = x.shape[row_axis], x.shape[col_axis]
+    linear = transform_matrices[:, :2, :2]
+    if not (np.all(linear[:, 0, 0] == 1) and np.all(linear[:, 1, 1] == 1) and
+            np.all(linear[:, 0, 1] == 0) and np.all(linear[:, 1, 0] == 0)):
+        return None
+    offsets = transform_matrices[:, :2, 2]
+    shifts = np.floor(offsets + 0.5).astype(np.intp)
+    # The source pixels apply_transform_batch would take
+    for axis, size in [(0, h), (1, w)]:
+        coords = offsets[:, axis, np.newaxis] + np.arange(size, dtype=np.float64)
+        taken = np.clip(np.floor(coords + 0.5), 0, size - 1)
+        cropped = np.clip(np.arange(size) + shifts[:, axis, np.newaxis], 0, size - 1)
+        if not np.array_equal(taken, cropped):
+            return None
+
+    pad_rows, pad_cols = np.abs(shifts).max(axis=0) if n else (0, 0)
+    pad_width = [(0, 0)] * x.ndim
+    pad_width[row_axis] = (pad_rows, pad_rows)
+    pad_width[col_axis] = (pad_cols, pad_cols)
+    padded = np.pad(x, pad_width, mode='edge')
+    img_row_axis, img_col_axis = row_axis - 1, col_axis - 1
+    out = np.empty_like(x)
+    for i in range(n):
+        index = [slice(None)] * (x.ndim - 1)
+        top = pad_rows + shifts[i, 0]
+        left = pad_cols + shifts[i, 1]
+        index[img_row_axis] = slice(top, top + h)
+        index[img_col_axis] = slice(left, left + w)
+        crop = padded[i][tuple(index)]
+        if flip_rows is not None and flip_rows[i]:
+            crop = flip_axis(crop, img_row_axis)
+        if flip_cols is not None and flip_cols[i]:
+            crop = flip_axis(crop, img_col_axis)
+        out[i] = crop
+    return out
+
+
+def _uniform(u, low, high):
+    """Scale `np.random.random_sample` values as `np.random.uniform` does."""
+    return low + (high - low) * u
+
+
+def _stack_matrices(rows, n):
+    """Build `n` 3x3 matrices whose entries are scalars or arrays of length n."""
+    matrices = np.empty((n, 3, 3))
+    for i, row in enumerate(rows):
+        for j, value in enumerate(row):
+            matrices[:, i, j] = value
+    return matrices
+
+
 def flip_axis(x, axis):
     x = np.asarray(x).swapaxes(axis, 0)
     x = x[::-1, ...]
@@ -337,6 +470,53 @@ def list_pictures(directory, ext='jpg|jpeg|bmp|png'):
             if re.match(r'([\w]+\.(?:' + ext + '))', f)]
 
 
+def _jitter_hsv(r, g, b, hue_shift, saturation_scale, saturation_shift,
+                value_scale, value_shift):
+    """Jitter the HSV representation of RGB planes in place.
+
+    `r`, `g` and `b` are float arrays of shape (examples, rows, cols) with
+    values in [0, 1]; the parameters are arrays of shape (examples, 1, 1).
+    HSV is computed once and converted back with the closed form of
+    `hsv_to_rgb`, so no per-sector masks and no float64 copies are needed.
+    """
+    value = np.maximum(np.maximum(r, g), b)
+    delta = value - np.minimum(np.minimum(r, g), b)
+    nonzero = delta > 0
+    safe_delta = np.where(nonzero, delta, 1)
+
+    # Hue in sixths of the color circle, the channel with the maximum wins
+    # (blue over green over red, as in rgb_to_hsv)
+    hue = np.where(b == value, 4 + (r - g) / safe_delta,
+                   np.where(g == value, 2 + (b - r) / safe_delta,
+                            (g - b) / safe_delta))
+    hue *= nonzero
+    np.mod(hue, 6, out=hue)
+    hue += 6 * hue_shift
+    np.clip(hue, 0, 6, out=hue)
+
+    saturation = np.divide(delta, np.where(value > 0, value, 1), out=delta)
+    saturation *= saturation_scale
+    saturation += saturation_shift
+    np.clip(saturation, 0, 1, out=saturation)
+
+    value *= value_scale
+    value += value_shift
+    np.clip(value, 0, 1, out=value)
+
+    # channel = V - V * S * clip(min(k, 4 - k), 0, 1), k = (n + H) mod 6
+    saturation *= value
+    k = np.empty_like(hue)
+    weight = np.empty_like(hue)
+    for channel, n in [(r, 5), (g, 3), (b, 1)]:
+        np.add(hue, n, out=k)
+        np.mod(k, 6, out=k)
+        np.subtract(4, k, out=weight)
+        np.minimum(weight, k, out=weight)
+        np.clip(weight, 0, 1, out=weight)
+        weight *= saturation
+        np.subtract(value, weight, out=channel)
+
+
 def hsv_augmentation(x, hue_shift,
                      saturation_scale, saturation_shift,
                      value_scale, value_shift, dim_ordering='default'):
@@ -344,41 +524,43 @@ def hsv_augmentation(x, hue_shift,
        HSV color representations of a batch of images using values drawn from
        uniform distributions:
            H += U(-hue_shift, +hue_shift)
-           S *= U(1/(1+saturation_scale), 1+saturation_scale)
+           S *= U(1/(1+saturation_scale), saturation_scale)
            S += U(-saturation_shift, +saturation_shift)
            V *= U(1/(1+value_scale), 1+value_scale)
            V += U(-value_shift, value_shift)
-    """
-    from matplotlib.colors import rgb_to_hsv, hsv_to_rgb
 
+       A float batch is changed in place (other dtypes are converted to
+       float32). Assumes x has already been rescaled to [0, 1].
+    """
     if dim_ordering == 'default':
         dim_ordering = K.image_dim_ordering()
     if dim_ordering not in {'th', 'tf'}:
         raise ValueError('Unknown dim_ordering: ', dim_ordering)
 
     assert x.ndim == 4, "Input of shape (examples, x, y, channels) is expected."
-    if dim_ordering == 'th':
-        x = x.transpose(0, 2, 3, 1)
-    assert x.shape[3] == 3, "RGB image with three channels is expected."
+    channel_axis = 1 if dim_ordering == 'th' else 3
+    assert x.shape[channel_axis] == 3, "RGB image with three channels is expected."
+    if x.dtype.kind != 'f':
+        x = x.astype(np.float32)
 
     nexamples = x.shape[0]
-    # Assumes x has already been rescaled by (1./255)
-    hsv = rgb_to_hsv(x)
     saturation_scale, value_scale = float(saturation_scale), float(value_scale)
 
-    hsv[..., 0] += np.random.uniform(low=-hue_shift, high=hue_shift, size=nexamples).reshape(nexamples, 1, 1)
-    hsv[..., 1] *= np.random.uniform(low=1/(1+saturation_scale), high=saturation_scale, size=nexamples).reshape(nexamples, 1, 1)
-    hsv[..., 1] += np.random.uniform(low=-saturation_shift, high=saturation_shift, size=nexamples).reshape(nexamples, 1, 1)
-    hsv[..., 2] *= np.random.uniform(low=1/(1+value_scale), high=1+value_scale, size=nexamples).reshape(nexamples, 1, 1)
-    hsv[..., 2] += np.random.uniform(low=-value_shift, high=value_shift, size=nexamples).reshape(nexamples, 1, 1)
-
-    # Note that it is necessary to rescale by 255 and convert to np.uint8 to obtain RGB image
-    rgb = (hsv_to_rgb(np.clip(hsv, 0, 1)))
+    # Same draws (and order) as the former matplotlib implementation
+    shape = (nexamples, 1, 1)
+    params = [np.random.uniform(low=-hue_shift, high=hue_shift, size=nexamples),
+              np.random.uniform(low=1/(1+saturation_scale), high=saturation_scale, size=nexamples),
+              np.random.uniform(low=-saturation_shift, high=saturation_shift, size=nexamples),
+              np.random.uniform(low=1/(1+value_scale), high=1+value_scale, size=nexamples),
+              np.random.uniform(low=-value_shift, high=value_shift, size=nexamples)]
+    params = [param.astype(x.dtype).reshape(shape) for param in params]
 
     if dim_ordering == 'th':
-        rgb = rgb.transpose(0, 3, 1, 2)
-
-    return rgb
+        r, g, b = x[:, 0], x[:, 1], x[:, 2]
+    else:
+        r, g, b = x[..., 0], x[..., 1], x[..., 2]
+    _jitter_hsv(r, g, b, *params)
+    return x
 
 
 class ImageDataGenerator(object):
@@ -502,7 +684,28 @@ class ImageDataGenerator(object):
                              'Received arg: ', zoom_range)
 
     def flow(self, x, y=None, batch_size=32, shuffle=True, seed=None,
-             save_to_dir=None, save_prefix='', save_format='jpeg'):
+             save_to_dir=None, save_prefix='', save_format='jpeg',
+             workers=0, n_buffers=0, preprocess=None):
+        """Iterate over augmented batches of x (and y).
+
+        With `workers > 0` the batches are augmented by that many worker
+        processes (see `MultiprocessNumpyArrayIterator`), which always use
+        a ring of shared buffers. Otherwise `n_buffers > 0` reuses that
+        many batch buffers (see `NumpyArrayIterator`). `preprocess` is
+        applied to every raw batch before the augmentation.
+        """
+        if workers > 0:
+            return MultiprocessNumpyArrayIterator(
+                x, y, self,
+                batch_size=batch_size,
+                shuffle=shuffle,
+                seed=seed,
+                data_format=self.data_format,
+                save_to_dir=save_to_dir,
+                save_prefix=save_prefix,
+                save_format=save_format,
+                workers=workers,
+                preprocess=preprocess)
         return NumpyArrayIterator(
             x, y, self,
             batch_size=batch_size,
@@ -511,7 +714,9 @@ class ImageDataGenerator(object):
             data_format=self.data_format,
             save_to_dir=save_to_dir,
             save_prefix=save_prefix,
-            save_format=save_format)
+            save_format=save_format,
+            n_buffers=n_buffers,
+            preprocess=preprocess)
 
     def flow_from_directory(self, directory,
                             target_size=(256, 256), color_mode='rgb',
@@ -520,7 +725,8 @@ class ImageDataGenerator(object):
                             save_to_dir=None,
                             save_prefix='',
                             save_format='jpeg',
-                            follow_links=False):
+                            follow_links=False,
+                            n_buffers=0):
         return DirectoryIterator(
             directory, self,
             target_size=target_size, color_mode=color_mode,
@@ -530,7 +736,8 @@ class ImageDataGenerator(object):
             save_to_dir=save_to_dir,
             save_prefix=save_prefix,
             save_format=save_format,
-            follow_links=follow_links)
+            follow_links=follow_links,
+            n_buffers=n_buffers)
 
     def standardize(self, x):
         """Apply the normalization configuration to a batch of inputs.
@@ -666,6 +873,190 @@ class ImageDataGenerator(object):
 
         return x
 
+    def standardize_batch(self, x):
+        """Apply the normalization configuration to a batch of images.
+
+        Gives the same result as `standardize` on every image.
+
+        # Arguments
+            x: batch of inputs to be normalized.
+
+        # Returns
+            The inputs, normalized.
+        """
+        if self.preprocessing_function:
+            # The function is defined for single images
+            x = np.stack([self.preprocessing_function(img) for img in x])
+        if self.rescale:
+            x *= self.rescale
+        if self.samplewise_center:
+            x -= np.mean(x, axis=self.channel_axis, keepdims=True)
+        if self.samplewise_std_normalization:
+            x /= (np.std(x, axis=self.channel_axis, keepdims=True) + 1e-7)
+
+        if self.featurewise_center:
+            if self.mean is not None:
+                x -= self.mean
+            else:
+                warnings.warn('This ImageDataGenerator specifies '
+                              '`featurewise_center`, but it hasn\'t'
+                              'been fit on any training data. Fit it '
+                              'first by calling `.fit(numpy_data)`.')
+        if self.featurewise_std_normalization:
+            if self.std is not None:
+                x /= (self.std + 1e-7)
+            else:
+                warnings.warn('This ImageDataGenerator specifies '
+                              '`featurewise_std_normalization`, but it hasn\'t'
+                              'been fit on any training data. Fit it '
+                              'first by calling `.fit(numpy_data)`.')
+        if self.zca_whitening:
+            if self.principal_components is not None:
+                # Image by image: a matrix product of the whole batch would
+                # round differently
+                for i in range(len(x)):
+                    flatx = np.reshape(x[i], (x[i].size))
+                    whitex = np.dot(flatx, self.principal_components)
+                    x[i] = np.reshape(whitex, x[i].shape)
+            else:
+                warnings.warn('This ImageDataGenerator specifies '
+                              '`zca_whitening`, but it hasn\'t'
+                              'been fit on any training data. Fit it '
+                              'first by calling `.fit(numpy_data)`.')
+        return x
+
+    def random_transform_batch(self, x, copy=True):
+        """Randomly augment a batch of image tensors.
+
+        The random parameters of all images are drawn at once, in the order
+        in which `random_transform` draws them image by image, and all
+        images are warped with one call of `apply_transform_batch`. For a
+        given seed the result is the same as calling `random_transform`
+        on every image, which is still done for fill modes other than
+        'nearest' and 'constant'.
+
+        # Arguments
+            x: 4D tensor, batch of images.
+            copy: Boolean, if False `x` may be modified in place.
+
+        # Returns
+            A randomly transformed version of the input (same shape).
+        """
+        if self.fill_mode not in {'constant', 'nearest'}:
+            return np.stack([self.random_transform(img) for img in x])
+        batch = x
+        n = x.shape[0]
+        h, w = x.shape[self.row_axis], x.shape[self.col_axis]
+        n_channels = x.shape[self.channel_axis]
+        zoom = not (self.zoom_range[0] == 1 and self.zoom_range[1] == 1)
+
+        # Random numbers of one image in the order of random_transform
+        draws = [('theta', 1 if self.rotation_range else 0),
+                 ('tx', 1 if self.height_shift_range else 0),
+                 ('ty', 1 if self.width_shift_range else 0),
+                 ('shear', 1 if self.shear_range else 0),
+                 ('zoom', 2 if zoom else 0),
+                 ('channel_shift',
+                  n_channels if self.channel_shift_range != 0 else 0),
+                 ('horizontal_flip', 1 if self.horizontal_flip else 0),
+                 ('vertical_flip', 1 if self.vertical_flip else 0)]
+        u = np.random.random_sample((n, sum(size for _, size in draws)))
+        params = {}
+        start = 0
+        for name, size in draws:
+            params[name] = u[:, start:start + size]
+            start += size
+
+        tx, ty = 0, 0
+        if self.height_shift_range:
+            tx = _uniform(params['tx'][:, 0], -self.height_shift_range,
+                          self.height_shift_range) * h
+        if self.width_shift_range:
+            ty = _uniform(params['ty'][:, 0], -self.width_shift_range,
+                          self.width_shift_range) * w
+
+        transform_matrix = None
+        if self.rotation_range:
+            theta = np.pi / 180 * _uniform(params['theta'][:, 0],
+                                           -self.rotation_range,
+                                           self.rotation_range)
+            transform_matrix = _stack_matrices(
+                [[np.cos(theta), -np.sin(theta), 0],
+                 [np.sin(theta), np.cos(theta), 0],
+                 [0, 0, 1]], n)
+
+        if self.height_shift_range or self.width_shift_range:
+            shift_matrix = _stack_matrices([[1, 0, tx],
+                                            [0, 1, ty],
+                                            [0, 0, 1]], n)
+            transform_matrix = shift_matrix if transform_matrix is None else np.matmul(transform_matrix, shift_matrix)
+
+        if self.shear_range:
+            shear = _uniform(params['shear'][:, 0],
+                             -self.shear_range, self.shear_range)
+            shear_matrix = _stack_matrices([[1, -np.sin(shear), 0],
+                                            [0, np.cos(shear), 0],
+                                            [0, 0, 1]], n)
+            transform_matrix = shear_matrix if transform_matrix is None else np.matmul(transform_matrix, shear_matrix)
+
+        if zoom:
+            zx, zy = _uniform(params['zoom'].T, self.zoom_range[0],
+                              self.zoom_range[1])
+            zoom_matrix = _stack_matrices([[zx, 0, 0],
+                                           [0, zy, 0],
+                                           [0, 0, 1]], n)
+            transform_matrix = zoom_matrix if transform_matrix is None else np.matmul(transform_matrix, zoom_matrix)
+
+        flip_cols, flip_rows = None, None
+        if self.horizontal_flip:
+            flip_cols = params['horizontal_flip'][:, 0] < 0.5
+        if self.vertical_flip:
+            flip_rows = params['vertical_flip'][:, 0] < 0.5
+
+        if transform_matrix is not None:
+            transform_matrix = transform_matrix_offset_center(transform_matrix, h, w)
+            shifted = None
+            if self.fill_mode == 'nearest':
+                # Translations only (e.g. width/height shift and flips) are
+                # integer crops. The flips are done while cropping; the
+                # channel shift below does not depend on the pixel order.
+                shifted = apply_translation_batch(x, transform_matrix,
+                                                  self.row_axis, self.col_axis,
+                                                  flip_rows, flip_cols)
+            if shifted is not None:
+                x = shifted
+                flip_cols, flip_rows = None, None
+            else:
+                x = apply_transform_batch(x, transform_matrix,
+                                          self.channel_axis,
+                                          fill_mode=self.fill_mode,
+                                          cval=self.cval)
+
+        if self.channel_shift_range != 0:
+            # Same as random_channel_shift: shift each channel, clip to the
+            # value range of the image
+            shape = [n] + [1] * (x.ndim - 1)
+            flat = x.reshape(n, -1)
+            min_x = flat.min(axis=1).reshape(shape)
+            max_x = flat.max(axis=1).reshape(shape)
+            shape[self.channel_axis] = n_channels
+            shift = _uniform(params['channel_shift'],
+                             -self.channel_shift_range,
+                             self.channel_shift_range)
+            x = np.clip(x + shift.astype(x.dtype).reshape(shape),
+                        min_x, max_x)
+
+        if (flip_cols is not None or flip_rows is not None) and x is batch and copy:
+            # the images are flipped in place
+            x = x.copy()
+        if flip_cols is not None:
+            x[flip_cols] = flip_axis(x[flip_cols], self.col_axis)
+
+        if flip_rows is not None:
+            x[flip_rows] = flip_axis(x[flip_rows], self.row_axis)
+
+        return x
+
     def hsv_augment(self, x):
         x = hsv_augmentation(x, *self.hsv_parameters)
         return x
@@ -692,7 +1083,8 @@ class ImageDataGenerator(object):
         # Raises
             ValueError: in case of invalid input `x`.
         """
-        x = np.asarray(x, dtype=K.floatx())
+        # np.array copies, so x can be modified in place below
+        x = np.array(x, dtype=K.floatx())
         if x.ndim != 4:
             raise ValueError('Input to `.fit()` should have rank 4. '
                              'Got array with shape: ' + str(x.shape))
@@ -708,7 +1100,6 @@ class ImageDataGenerator(object):
         if seed is not None:
             np.random.seed(seed)
 
-        x = np.copy(x)
         if augment:
             ax = np.zeros(tuple([rounds * x.shape[0]] + list(x.shape)[1:]), dtype=K.floatx())
             for r in range(rounds):
@@ -736,6 +1127,46 @@ class ImageDataGenerator(object):
             u, s, _ = linalg.svd(sigma)
             self.principal_components = np.dot(np.dot(u, np.diag(1. / np.sqrt(s + 10e-7))), u.T)
 
+    def fit_from_statistics(self, statistics):
+        """Sets the internal statistics from precomputed dataset statistics.
+
+        Equivalent to `fit(x)` (without augmentation), but `x` never has to
+        be in memory.
+
+        # Arguments
+            statistics: dict-like (e.g. `np.load` of the file written by
+                `create_statistics.py`) with 'channel_mean' and
+                'channel_std' and - for zca_whitening - the per-feature
+                'mean' and 'covariance' of the flattened examples.
+        """
+        channel_mean = np.asarray(statistics['channel_mean'])
+        broadcast_shape = [1, 1, 1]
+        broadcast_shape[self.channel_axis - 1] = channel_mean.shape[0]
+        channel_mean = np.reshape(channel_mean, broadcast_shape)
+        channel_std = np.reshape(statistics['channel_std'], broadcast_shape)
+
+        if self.featurewise_center:
+            self.mean = channel_mean.astype(K.floatx())
+
+        if self.featurewise_std_normalization:
+            self.std = channel_std.astype(K.floatx())
+
+        if self.zca_whitening:
+            mean = np.asarray(statistics['mean'])
+            flat_mean = mean.reshape(-1)
+            # second moment of the data as fit() sees it
+            sigma = statistics['covariance'] + np.outer(flat_mean, flat_mean)
+            if self.featurewise_center:
+                m = np.broadcast_to(channel_mean, mean.shape).reshape(-1)
+                sigma = (sigma - np.outer(m, flat_mean) -
+                         np.outer(flat_mean, m) + np.outer(m, m))
+            if self.featurewise_std_normalization:
+                s = np.broadcast_to(channel_std + K.epsilon(),
+                                    mean.shape).reshape(-1)
+                sigma = sigma / np.outer(s, s)
+            u, s, _ = linalg.svd(sigma)
+            self.principal_components = np.dot(np.dot(u, np.diag(1. / np.sqrt(s + 10e-7))), u.T)
+
 
 class Iterator(object):
     """Abstract base class for image data iterators.
@@ -745,9 +1176,12 @@ class Iterator(object):
         batch_size: Integer, size of a batch.
         shuffle: Boolean, whether to shuffle the data between epochs.
         seed: Random seeding for data shuffling.
+        n_buffers: Integer, if > 0 the batches are built in a ring of
+            `n_buffers` preallocated buffers. A returned batch is then
+            overwritten by the `n_buffers`-th following call of `next`.
     """
 
-    def __init__(self, n, batch_size, shuffle, seed):
+    def __init__(self, n, batch_size, shuffle, seed, n_buffers=0):
         self.n = n
         self.batch_size = batch_size
         self.shuffle = shuffle
@@ -755,10 +1189,31 @@ class Iterator(object):
         self.total_batches_seen = 0
         self.lock = threading.Lock()
         self.index_generator = self._flow_index(n, batch_size, shuffle, seed)
+        self.n_buffers = n_buffers
+        self._buffers = []
+        self._buffer_index = 0
 
     def reset(self):
         self.batch_index = 0
 
+    def _allocate_buffers(self):
+        """Allocate the buffers of one batch, see `_next_buffers`."""
+        raise NotImplementedError
+
+    def _next_buffers(self):
+        """Get the buffers of the next batch of the ring (or None).
+
+        The buffers are allocated on first use. Has to be called while
+        holding `self.lock`.
+        """
+        if self.n_buffers <= 0:
+            return None
+        if len(self._buffers) < self.n_buffers:
+            self._buffers.append(self._allocate_buffers())
+        buffers = self._buffers[self._buffer_index]
+        self._buffer_index = (self._buffer_index + 1) % self.n_buffers
+        return buffers
+
     def _flow_index(self, n, batch_size=32, shuffle=False, seed=None):
         # Ensure self.batch_index is 0.
         self.reset()
@@ -794,7 +1249,8 @@ class NumpyArrayIterator(Iterator):
     """Iterator yielding data from a Numpy array.
 
     # Arguments
-        x: Numpy array of input data.
+        x: Numpy array of input data, or an array-like with `shape`,
+            `dtype`, `take` and numpy indexing (e.g. a `RecordStore`).
         y: Numpy array of targets data.
         image_data_generator: Instance of `ImageDataGenerator`
             to use for random transformations and normalization.
@@ -810,12 +1266,21 @@ class NumpyArrayIterator(Iterator):
             images (if `save_to_dir` is set).
         save_format: Format to use for saving sample images
             (if `save_to_dir` is set).
+        n_buffers: Integer, number of reused batch buffers (see
+            `Iterator`). The images are gathered and cast to float into
+            them in place, the targets are gathered into label buffers.
+        preprocess: Optional function which gets every gathered batch of
+            `x` before it is augmented and returns a new float array, e.g.
+            the `preprocess` function of a dataset module. `x` then only
+            has to be valid input of it (e.g. uint8 images without channel
+            axis); the shape checks apply to its output.
     """
 
     def __init__(self, x, y, image_data_generator,
                  batch_size=32, shuffle=False, seed=None,
                  data_format=None,
-                 save_to_dir=None, save_prefix='', save_format='jpeg'):
+                 save_to_dir=None, save_prefix='', save_format='jpeg',
+                 n_buffers=0, preprocess=None):
         if y is not None and len(x) != len(y):
             raise ValueError('X (images tensor) and y (labels) '
                              'should have the same length. '
@@ -824,20 +1289,29 @@ class NumpyArrayIterator(Iterator):
 
         if data_format is None:
             data_format = K.image_data_format()
-        self.x = np.asarray(x, dtype=K.floatx())
+        # Keep the dtype (e.g. uint8); images are converted batch by batch.
+        # Array-likes with `take` (e.g. a RecordStore on disk) are only
+        # indexed per batch, never read as a whole.
+        self.x = x if hasattr(x, 'take') else np.asarray(x)
+        self.preprocess = preprocess
+        if preprocess is None:
+            self.image_shape = self.x.shape[1:]
+        else:
+            self.image_shape = preprocess(self.x[:1]).shape[1:]
+        shape = (len(self.x),) + self.image_shape
 
-        if self.x.ndim != 4:
+        if len(shape) != 4:
             raise ValueError('Input data in `NumpyArrayIterator` '
                              'should have rank 4. You passed an array '
-                             'with shape', self.x.shape)
+                             'with shape', shape)
         channels_axis = 3 if data_format == 'channels_last' else 1
-        if self.x.shape[channels_axis] not in {1, 3, 4}:
+        if shape[channels_axis] not in {1, 3, 4}:
             raise ValueError('NumpyArrayIterator is set to use the '
                              'data format convention "' + data_format + '" '
                              '(channels on axis ' + str(channels_axis) + '), i.e. expected '
                              'either 1, 3 or 4 channels on axis ' + str(channels_axis) + '. '
-                             'However, it was passed an array with shape ' + str(self.x.shape) +
-                             ' (' + str(self.x.shape[channels_axis]) + ' channels).')
+                             'However, it was passed an array with shape ' + str(shape) +
+                             ' (' + str(shape[channels_axis]) + ' channels).')
         if y is not None:
             self.y = np.asarray(y)
         else:
@@ -847,7 +1321,25 @@ class NumpyArrayIterator(Iterator):
         self.save_to_dir = save_to_dir
         self.save_prefix = save_prefix
         self.save_format = save_format
-        super(NumpyArrayIterator, self).__init__(x.shape[0], batch_size, shuffle, seed)
+        super(NumpyArrayIterator, self).__init__(x.shape[0], batch_size, shuffle, seed,
+                                                 n_buffers=n_buffers)
+
+    def _allocate_buffers(self):
+        """Get `(raw, batch_x, batch_y)` buffers of `batch_size` examples.
+
+        `raw` has the dtype and image shape of `x`. It is `batch_x` if `x`
+        is `floatx` and does not get preprocessed.
+        """
+        batch_x = np.empty((self.batch_size,) + self.image_shape, dtype=K.floatx())
+        if self.x.dtype == batch_x.dtype and self.preprocess is None:
+            raw = batch_x
+        else:
+            raw = np.empty((self.batch_size,) + self.x.shape[1:], dtype=self.x.dtype)
+        batch_y = None
+        if self.y is not None:
+            batch_y = np.empty((self.batch_size,) + self.y.shape[1:],
+                               dtype=self.y.dtype)
+        return raw, batch_x, batch_y
 
     def next(self):
         """For python 2.x.
@@ -859,14 +1351,55 @@ class NumpyArrayIterator(Iterator):
         # the indexing of each batch.
         with self.lock:
             index_array, current_index, current_batch_size = next(self.index_generator)
+            buffers = self._next_buffers()
         # The transformation of images is not under thread lock
         # so it can be done in parallel
-        batch_x = np.zeros(tuple([current_batch_size] + list(self.x.shape)[1:]), dtype=K.floatx())
-        for i, j in enumerate(index_array):
-            x = self.x[j]
-            x = self.image_data_generator.random_transform(x.astype(K.floatx()))
-            x = self.image_data_generator.standardize(x)
-            batch_x[i] = x
+        batch_x = self._transform_batch(index_array, current_index, buffers)
+        if self.y is None:
+            return batch_x
+        if buffers is None:
+            batch_y = self.y[index_array]
+        else:
+            batch_y = np.take(self.y, index_array, axis=0,
+                              out=buffers[2][:current_batch_size], mode='clip')
+        return batch_x, batch_y
+
+    def _transform_batch(self, index_array, current_index, buffers=None):
+        """Get the augmented and standardized images of index_array.
+
+        With `buffers` (see `_allocate_buffers`) the images are gathered
+        into `raw`, cast (or preprocessed) into `batch_x` and the result is
+        `batch_x`.
+        """
+        current_batch_size = len(index_array)
+        if buffers is None:
+            out = None
+            if self.preprocess is None:
+                batch_x = self.x[index_array].astype(K.floatx())
+            else:
+                batch_x = self.preprocess(self.x[index_array])
+        else:
+            raw, out = buffers[0], buffers[1]
+            cast = raw is not out
+            raw, out = raw[:current_batch_size], out[:current_batch_size]
+            # The indices are valid; with mode='raise' np.take would write
+            # into a temporary array and copy it into out
+            np.take(self.x, index_array, axis=0, out=raw, mode='clip')
+            if self.preprocess is not None:
+                # copied into out after the augmentation
+                batch_x = self.preprocess(raw)
+            else:
+                if cast:
+                    out[...] = raw
+                batch_x = out
+        # batch_x is a new array, the flips may be done in place
+        batch_x = self.image_data_generator.random_transform_batch(batch_x, copy=False)
+        batch_x = self.image_data_generator.standardize_batch(batch_x)
+        if out is None:
+            batch_x = batch_x.astype(K.floatx(), copy=False)
+        elif batch_x is not out:
+            out[...] = batch_x
+            batch_x = out
         if self.image_data_generator.hsv_augmentation:
             batch_x = self.image_data_generator.hsv_augment(batch_x)
         if self.save_to_dir:
@@ -877,11 +1410,169 @@ class NumpyArrayIterator(Iterator):
                                                                   hash=np.random.randint(1e4),
                                                                   format=self.save_format)
                 img.save(os.path.join(self.save_to_dir, fname))
+        return batch_x
+
+
+def _augmentation_worker(iterator, tasks, results, buffers):
+    """Augment batches for a `MultiprocessNumpyArrayIterator`.
+
+    # Arguments
+        iterator: the iterator (inherited by fork, not pickled).
+        tasks: queue of `(batch number, slot, index_array, current_index,
+            random state)` tuples; `None` stops the worker.
+        results: queue for `(batch number, traceback or None)` tuples.
+        buffers: list of shared numpy arrays, one per slot.
+    """
+    # The images are gathered into raw, then cast and augmented in the slot
+    raw = np.empty((iterator.batch_size,) + iterator.x.shape[1:],
+                   dtype=iterator.x.dtype)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        number, slot, index_array, current_index, random_state = task
+        try:
+            np.random.set_state(random_state)
+            iterator._transform_batch(index_array, current_index,
+                                      (raw, buffers[slot], None))
+            results.put((number, None))
+        except Exception:
+            results.put((number, traceback.format_exc()))
+
+
+class MultiprocessNumpyArrayIterator(NumpyArrayIterator):
+    """Iterator yielding data from a Numpy array, augmented by processes.
+
+    Worker processes augment the batches and write them into a ring of
+    shared-memory buffers. The returned batches are views of these
+    buffers, so they are not copied into the training process. A returned
+    batch is overwritten after `n_keep` further batches were returned;
+    `n_keep` has to be bigger than the number of batches the consumer
+    queues (`max_q_size` of `fit_generator` plus the batch in training).
+
+    Every batch gets its own random state from the training process: with
+    a `seed`, the same state `NumpyArrayIterator` would use, so the batches
+    are identical to it. Without a seed, a seed per batch is drawn from
+    `np.random`. The result does not depend on which worker augments a
+    batch.
+
+    The workers are forked, so `x` is shared with them and does not get
+    pickled.
+
+    # Arguments
+        x, y, image_data_generator, batch_size, shuffle, seed, data_format,
+        save_to_dir, save_prefix, save_format, preprocess: see
+            `NumpyArrayIterator`.
+        workers: Integer, number of worker processes.
+        prefetch: Integer, number of batches which are augmented ahead
+            (default: `2 * workers`).
+        n_keep: Integer, see above.
+    """
+
+    def __init__(self, x, y, image_data_generator,
+                 batch_size=32, shuffle=False, seed=None,
+                 data_format=None,
+                 save_to_dir=None, save_prefix='', save_format='jpeg',
+                 workers=1, prefetch=None, n_keep=12, preprocess=None):
+        super(MultiprocessNumpyArrayIterator, self).__init__(
+            x, y, image_data_generator,
+            batch_size=batch_size, shuffle=shuffle, seed=seed,
+            data_format=data_format,
+            save_to_dir=save_to_dir, save_prefix=save_prefix,
+            save_format=save_format, preprocess=preprocess)
+        self.seed = seed
+        self.workers = workers
+        self.prefetch = prefetch if prefetch is not None else 2 * workers
+        self.n_keep = n_keep
+        # A slot is reused n_buffers batches later
+        self.n_buffers = n_keep + self.prefetch + 1
+
+        shape = (batch_size,) + self.image_shape
+        dtype = np.dtype(K.floatx())
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        self._buffers = []
+        for _ in range(self.n_buffers):
+            raw = multiprocessing.RawArray(ctypes.c_byte, nbytes)
+            self._buffers.append(np.frombuffer(raw, dtype=dtype).reshape(shape))
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._n_submitted = 0
+        self._n_returned = 0
+        self._pending = {}
+        self._done = set()
+        self._processes = []
+        for _ in range(workers):
+            process = multiprocessing.Process(
+                target=_augmentation_worker,
+                args=(self, self._tasks, self._results, self._buffers))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+
+    def _submit(self):
+        """Hand out batches until `prefetch` batches are in flight."""
+        while self._n_submitted < self._n_returned + self.prefetch:
+            index_array, current_index, _ = next(self.index_generator)
+            if self.seed is not None:
+                # the state the augmentation of NumpyArrayIterator starts in
+                random_state = np.random.get_state()
+            else:
+                batch_seed = np.random.randint(2 ** 31 - 1)
+                random_state = np.random.RandomState(batch_seed).get_state()
+            number = self._n_submitted
+            slot = number % self.n_buffers
+            self._pending[number] = index_array
+            self._tasks.put((number, slot, index_array, current_index,
+                             random_state))
+            self._n_submitted += 1
+
+    def next(self):
+        """For python 2.x.
+
+        # Returns
+            The next batch.
+        """
+        with self.lock:
+            self._submit()
+            number = self._n_returned
+            while number not in self._done:
+                try:
+                    done, error = self._results.get(timeout=1)
+                except queue.Empty:
+                    if not all(process.is_alive()
+                               for process in self._processes):
+                        self.close()
+                        raise RuntimeError('An augmentation worker died.')
+                    continue
+                if error is not None:
+                    self.close()
+                    raise RuntimeError('Augmentation worker failed:\n' +
+                                       error)
+                self._done.add(done)
+            self._done.remove(number)
+            index_array = self._pending.pop(number)
+            self._n_returned += 1
+            self._submit()
+        batch_x = self._buffers[number % self.n_buffers][:len(index_array)]
         if self.y is None:
             return batch_x
         batch_y = self.y[index_array]
         return batch_x, batch_y
 
+    def close(self):
+        """Stop the worker processes."""
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+
+    def __del__(self):
+        if getattr(self, '_processes', None):
+            self.close()
+
 
 class DirectoryIterator(Iterator):
     """Iterator capable of reading images from a directory on disk.
@@ -916,6 +1607,8 @@ class DirectoryIterator(Iterator):
             images (if `save_to_dir` is set).
         save_format: Format to use for saving sample images
             (if `save_to_dir` is set).
+        n_buffers: Integer, number of reused batch and label buffers
+            (see `Iterator`). The images are loaded into them.
     """
 
     def __init__(self, directory, image_data_generator,
@@ -924,7 +1617,7 @@ class DirectoryIterator(Iterator):
                  batch_size=32, shuffle=True, seed=None,
                  data_format=None,
                  save_to_dir=None, save_prefix='', save_format='jpeg',
-                 follow_links=False):
+                 follow_links=False, n_buffers=0):
         if data_format is None:
             data_format = K.image_data_format()
         self.directory = directory
@@ -1003,7 +1696,21 @@ class DirectoryIterator(Iterator):
                         # add filename relative to directory
                         absolute_path = os.path.join(root, fname)
                         self.filenames.append(os.path.relpath(absolute_path, directory))
-        super(DirectoryIterator, self).__init__(self.samples, batch_size, shuffle, seed)
+        super(DirectoryIterator, self).__init__(self.samples, batch_size, shuffle, seed,
+                                                n_buffers=n_buffers)
+
+    def _allocate_buffers(self):
+        """Get `(batch_x, batch_y)` buffers of `batch_size` examples."""
+        batch_x = np.empty((self.batch_size,) + self.image_shape, dtype=K.floatx())
+        if self.class_mode == 'sparse':
+            batch_y = np.empty((self.batch_size,), dtype=self.classes.dtype)
+        elif self.class_mode == 'binary':
+            batch_y = np.empty((self.batch_size,), dtype=K.floatx())
+        elif self.class_mode == 'categorical':
+            batch_y = np.empty((self.batch_size, self.num_class), dtype=K.floatx())
+        else:
+            batch_y = None
+        return batch_x, batch_y
 
     def next(self):
         """For python 2.x.
@@ -1013,9 +1720,19 @@ class DirectoryIterator(Iterator):
         """
         with self.lock:
             index_array, current_index, current_batch_size = next(self.index_generator)
+            buffers = self._next_buffers()
         # The transformation of images is not under thread lock
         # so it can be done in parallel
-        batch_x = np.zeros((current_batch_size,) + self.image_shape, dtype=K.floatx())
+        if buffers is None:
+            out, out_y = None, None
+            batch_x = np.zeros((current_batch_size,) + self.image_shape, dtype=K.floatx())
+        else:
+            out, out_y = buffers
+            out = out[:current_batch_size]
+            if out_y is not None:
+                out_y = out_y[:current_batch_size]
+            # every image is loaded into it
+            batch_x = out
         grayscale = self.color_mode == 'grayscale'
         # build batch of image data
         for i, j in enumerate(index_array):
@@ -1023,10 +1740,14 @@ class DirectoryIterator(Iterator):
             img = load_img(os.path.join(self.directory, fname),
                            grayscale=grayscale,
                            target_size=self.target_size)
-            x = img_to_array(img, data_format=self.data_format)
-            x = self.image_data_generator.random_transform(x)
-            x = self.image_data_generator.standardize(x)
-            batch_x[i] = x
+            batch_x[i] = img_to_array(img, data_format=self.data_format)
+        batch_x = self.image_data_generator.random_transform_batch(batch_x, copy=False)
+        batch_x = self.image_data_generator.standardize_batch(batch_x)
+        if out is None:
+            batch_x = batch_x.astype(K.floatx(), copy=False)
+        elif batch_x is not out:
+            out[...] = batch_x
+            batch_x = out
         if self.image_data_generator.hsv_augmentation:
             batch_x = self.image_data_generator.hsv_augment(batch_x)
         # optionally save augmented images to disk for debugging purposes
@@ -1040,13 +1761,23 @@ class DirectoryIterator(Iterator):
                 img.save(os.path.join(self.save_to_dir, fname))
         # build batch of labels
         if self.class_mode == 'sparse':
-            batch_y = self.classes[index_array]
+            if out_y is None:
+                batch_y = self.classes[index_array]
+            else:
+                batch_y = np.take(self.classes, index_array, out=out_y, mode='clip')
         elif self.class_mode == 'binary':
-            batch_y = self.classes[index_array].astype(K.floatx())
+            if out_y is None:
+                batch_y = self.classes[index_array].astype(K.floatx())
+            else:
+                batch_y = out_y
+                batch_y[...] = self.classes[index_array]
         elif self.class_mode == 'categorical':
-            batch_y = np.zeros((len(batch_x), self.num_class), dtype=K.floatx())
-            for i, label in enumerate(self.classes[index_array]):
-                batch_y[i, label] = 1.
+            if out_y is None:
+                batch_y = np.zeros((len(batch_x), self.num_class), dtype=K.floatx())
+            else:
+                batch_y = out_y
+                batch_y.fill(0.)
+            batch_y[np.arange(len(batch_x)), self.classes[index_array]] = 1.
         else:
             return batch_x
         return batch_x, batch_y
@@ -11,8 +11,11 @@ def make_mosaic(imgs, nrows, ncols, border=1, mode='tf'):
     mosaic with nrows and ncols
     """
     if mode == 'tf':
-        imgs = imgs.transpose(2, 0, 1)
-    imshape = imgs.shape[1:]
+        # The images are along the last axis; they are selected one by one
+        # instead of transposing the whole stack
+        imshape = imgs.shape[:-1]
+    else:
+        imshape = imgs.shape[1:]
 
     if len(imgs.shape) == 4:
         if imgs.shape[-1] >= 3:
@@ -32,7 +35,11 @@ def make_mosaic(imgs, nrows, ncols, border=1, mode='tf'):
     for i in range(nrows * ncols):
         row = int(np.floor(i / ncols))
         col = i % ncols
+        if mode == 'tf':
+            img = imgs[..., i]
+        else:
+            img = imgs[i]
 
         mosaic[row * paddedh:row * paddedh + imshape[0],
-               col * paddedw:col * paddedw + imshape[1], 0] = imgs[i]
+               col * paddedw:col * paddedw + imshape[1], 0] = img
     return mosaic.squeeze()
@@ -48,6 +48,76 @@ def get_parser():
     return parser
 
 
+class LazyModule(object):
+    """
+    A Python script which gets loaded on first use.
+
+    Every attribute access (including `__doc__` and `__name__`) and
+    assignment is forwarded to the module, so a LazyModule can be passed
+    wherever the loaded module is expected. Heavy dependencies of the
+    script (e.g. Keras) are only imported if it is actually used.
+
+    Parameters
+    ----------
+    name : str
+        Module name (as for `imp.load_source`)
+    path : str
+        Path to the Python script
+    sys_path : str, optional
+        Directory which gets added to sys.path before loading, e.g. for
+        the `from utils import ...` of the dataset scripts
+    """
+
+    def __init__(self, name, path, sys_path=None):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_path', path)
+        object.__setattr__(self, '_sys_path', sys_path)
+        object.__setattr__(self, '_module', None)
+
+    def _load(self):
+        if self._module is None:
+            if self._sys_path is not None and self._sys_path not in sys.path:
+                sys.path.insert(1, self._sys_path)
+            logging.info("Load {} from {}".format(self._name, self._path))
+            module = imp.load_source(self._name, self._path)
+            object.__setattr__(self, '_module', module)
+        return self._module
+
+    def __getattribute__(self, attr):
+        if attr in ('_name', '_path', '_sys_path', '_module', '_load'):
+            return object.__getattribute__(self, attr)
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+
+def load_modules(experiment_meta):
+    """
+    Get the modules of an experiment definition.
+
+    Parameters
+    ----------
+    experiment_meta : dict
+        With absolute paths (see make_paths_absolute)
+
+    Returns
+    -------
+    dict
+        LazyModule objects for 'data', 'model', 'optimizer' and 'train'
+        (only those which have a script_path)
+    """
+    modules = {}
+    for name, section in [('data', 'dataset'), ('model', 'model'),
+                          ('optimizer', 'optimizer'), ('train', 'train')]:
+        if section in experiment_meta and \
+                'script_path' in experiment_meta[section]:
+            path = experiment_meta[section]['script_path']
+            sys_path = os.path.dirname(path) if name == 'data' else None
+            modules[name] = LazyModule(name, path, sys_path=sys_path)
+    return modules
+
+
 def make_paths_absolute(dir_, experiment_meta):
     for key in experiment_meta.keys():
         if key.endswith("_path"):
@@ -76,12 +146,8 @@ if __name__ == "__main__":
     if not os.path.exists(experiment_meta['train']['artifacts_path']):
         os.makedirs(experiment_meta['train']['artifacts_path'])
 
-    dpath = experiment_meta['dataset']['script_path']
-    sys.path.insert(1, os.path.dirname(dpath))
-    data = imp.load_source('data', experiment_meta['dataset']['script_path'])
-    model = imp.load_source('model', experiment_meta['model']['script_path'])
-    optimizer = imp.load_source('optimizer',
-                                experiment_meta['optimizer']['script_path'])
-    train = imp.load_source('train', experiment_meta['train']['script_path'])
-    train.main(data, model, optimizer, os.path.abspath(args.filename),
-               config=experiment_meta)
+    modules = load_modules(experiment_meta)
+    modules['train'].main(modules['data'], modules['model'],
+                          modules['optimizer'],
+                          os.path.abspath(args.filename),
+                          config=experiment_meta)
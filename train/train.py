@@ -8,8 +8,9 @@ from __future__ import print_function
 # from datetime import datetime
 import time
 # import math
-# import numpy as np
 import os
+import threading
+from six.moves import queue
 
 import tensorflow as tf
 
@@ -50,8 +51,8 @@ def eval_network(sess, summary_writer, dataset, correct_prediction, epoch,
     total_test = 0
     batch_size = 1000
     for i in range(int(dataset.labels.shape[0] / batch_size)):
-        feed_dict = {x: dataset.images[i * batch_size:(i + 1) * batch_size],
-                     y_: dataset.labels[i * batch_size:(i + 1) * batch_size]}
+        images, labels = dataset.batch(i * batch_size, (i + 1) * batch_size)
+        feed_dict = {x: images, y_: labels}
         test_correct = correct_prediction.eval(feed_dict=feed_dict)
         correct_sum += sum(test_correct)
         total_test += len(test_correct)
@@ -84,6 +85,68 @@ def get_nonexisting_path(model_checkpoint_path):
         return gen_filename
 
 
+class BatchPrefetcher(object):
+    """
+    Prepare the next training batches in a background thread.
+
+    The batches are passed on as the dataset returns them, without a copy.
+    Besides the `n_batches` queued batches, the consumer holds one and the
+    producer one, so a dataset which reuses its batch buffers needs at
+    least `n_batches + 2` of them (e.g. `IndexedDataSet` with `n_buffers`).
+
+    Parameters
+    ----------
+    dataset : DataSet
+    batch_size : int
+    n_batches : int
+        Size of the bounded queue of prepared batches.
+
+    Attributes
+    ----------
+    wait_time : float
+        Seconds the training loop spent waiting for data. If this is a
+        notable part of the training time, the input is the bottleneck.
+    """
+
+    def __init__(self, dataset, batch_size, n_batches=4):
+        self.wait_time = 0.0
+        self._queue = queue.Queue(maxsize=n_batches)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce,
+                                        args=(dataset, batch_size))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce(self, dataset, batch_size):
+        while not self._stop.is_set():
+            try:
+                batch = dataset.next_batch(batch_size)
+            except Exception as e:
+                batch = e
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(batch, Exception):
+                return
+
+    def next_batch(self):
+        """Return the next prepared batch."""
+        t0 = time.time()
+        batch = self._queue.get()
+        self.wait_time += time.time() - t0
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def close(self):
+        """Stop the background thread."""
+        self._stop.set()
+        self._thread.join()
+
+
 def train(data,
           model,
           optimizer,
@@ -103,7 +166,9 @@ def train(data,
         # Get images and labels
         data.prepare(data.DATA_DIR)
         # data.visualize(42)
-        dataset = data.read_data_sets()
+        # The prefetcher needs prefetch_batches + 2 batch buffers
+        prefetch_batches = train_params.get('prefetch_batches', 4)
+        dataset = data.read_data_sets(n_buffers=prefetch_batches + 2)
         config['dataset']['meta'] = data.meta
 
         # Build a Graph that computes the logits predictions from the
@@ -130,17 +195,28 @@ def train(data,
         examples_per_epoch = config['dataset']['meta']['examples_per_epoch']
         num_batches_per_epoch = int(examples_per_epoch /
                                     train_params['batch_size'])
-        for i in range(int(train_params['epochs']) * num_batches_per_epoch):
-            batch = dataset.train.next_batch(train_params['batch_size'])
-            if i % num_batches_per_epoch == 0:
-                log_score(sess, summary_writer,
-                          validation_curve_path,
-                          dataset, correct_prediction, i, x, y_)
-            train_step.run(feed_dict={x: batch[0],
-                                      y_: batch[1]
-                                      })
+        prefetcher = BatchPrefetcher(dataset.train,
+                                     train_params['batch_size'],
+                                     prefetch_batches)
+        try:
+            for i in range(int(train_params['epochs']) *
+                           num_batches_per_epoch):
+                batch = prefetcher.next_batch()
+                if i % num_batches_per_epoch == 0:
+                    log_score(sess, summary_writer,
+                              validation_curve_path,
+                              dataset, correct_prediction, i, x, y_)
+                    print("Data wait time: %0.4fs" % prefetcher.wait_time)
+                train_step.run(feed_dict={x: batch[0],
+                                          y_: batch[1]
+                                          })
+        finally:
+            prefetcher.close()
         t1 = time.time()
         print("Time: %0.4fs" % (t1 - t0))
+        print("Data wait time: %0.4fs (%0.1f%%)"
+              % (prefetcher.wait_time,
+                 100.0 * prefetcher.wait_time / max(t1 - t0, 1e-7)))
 
 
 def main(data, model, optimizer, experiment_file, config):
@@ -54,15 +54,15 @@ class History(Callback):
 def flatten_completely(iterable):
     """Make a flat list out of an interable of iterables of iterables ..."""
     flattened = []
-    iterable = deepcopy(iterable)
-    queue = [iterable]
-    while len(queue) > 0:
-        el = queue.pop(0)
-        if isinstance(el, collections.Iterable):
-            for subel in el[::-1]:
-                queue.insert(0, subel)
-        else:
+    stack = [iter([iterable])]
+    while len(stack) > 0:
+        for el in stack[-1]:
+            if isinstance(el, collections.Iterable):
+                stack.append(iter(el))
+                break
             flattened.append(el)
+        else:
+            stack.pop()
     return flattened
 
 
@@ -75,12 +75,31 @@ def get_old_cli2new_cli(hierarchy):
     return old_cli2new_cli
 
 
+def get_class_lookup(old_cli2new_cli, n_classes=0):
+    """
+    Get an array which maps old class indices to new class indices.
+
+    Parameters
+    ----------
+    old_cli2new_cli : dict
+    n_classes : int, optional
+        Minimum length of the lookup array
+
+    Returns
+    -------
+    np.array
+        Classes which are not in old_cli2new_cli are mapped to -1.
+    """
+    n_classes = max([n_classes] + [cli + 1 for cli in old_cli2new_cli])
+    lookup = np.full(n_classes, -1, dtype=np.int64)
+    for old_cli, new_cli in old_cli2new_cli.items():
+        lookup[old_cli] = new_cli
+    return lookup
+
+
 def apply_hierarchy(hierarchy, y):
     """Apply a hierarchy to a label vector."""
-    oldi2newi = get_old_cli2new_cli(hierarchy)
-    for i in range(len(y)):
-        y[i] = oldi2newi[y[i][0]]
-    return y
+    return update_labels(y, get_old_cli2new_cli(hierarchy))
 
 
 def get_level(list_, level):
@@ -114,24 +133,182 @@ def get_level(list_, level):
         return list_
 
 
+def _get_classes(y):
+    """Get the class index of each example of a (n,) or (n, 1) label array."""
+    return np.reshape(y, (len(y), -1))[:, 0]
+
+
 def filter_by_class(X_old, y_old, remaining_cls):
     """Remove all instances of classes which are not in remaining_cls."""
-    X = []
-    y = []
-    for x_tmp, y_tmp in zip(X_old, y_old):
-        if y_tmp in remaining_cls:
-            X.append(x_tmp)
-            y.append(y_tmp)
-    return np.array(X), np.array(y)
+    classes = _get_classes(y_old)
+    if len(classes) == 0:
+        return X_old, y_old
+    keep = np.zeros(max([classes.max()] + list(remaining_cls)) + 1,
+                    dtype=bool)
+    keep[list(remaining_cls)] = True
+    mask = keep[classes]
+    return X_old[mask], y_old[mask]
 
 
 def update_labels(y, old_cli2new_cli):
     """Update labels y with a dictionary old_cli2new_cli."""
-    for i in range(len(y)):
-        y[i][0] = old_cli2new_cli[y[i][0]]
+    if len(y) == 0:
+        return y
+    lookup = get_class_lookup(old_cli2new_cli, n_classes=y.max() + 1)
+    y_new = lookup[y]
+    if (y_new < 0).any():
+        raise KeyError("Classes {} are not in old_cli2new_cli"
+                       .format(np.unique(y[y_new < 0]).tolist()))
+    y[...] = y_new
     return y
 
 
+def get_cm_indices(y_true, y_pred, n_classes):
+    """
+    Get the indices of the examples in each cell of the confusion matrix.
+
+    Parameters
+    ----------
+    y_true : np.array
+        True class of each example
+    y_pred : np.array
+        Predicted class of each example
+    n_classes : int
+
+    Returns
+    -------
+    dict
+        CSR-style index: the examples with true class i and predicted class
+        j are `indices[offsets[i * n_classes + j]:
+        offsets[i * n_classes + j + 1]]` (in ascending order).
+    """
+    cells = (np.asarray(y_true, dtype=np.int64) * n_classes +
+             np.asarray(y_pred, dtype=np.int64))
+    counts = np.bincount(cells, minlength=n_classes ** 2)
+    offsets = np.zeros(n_classes ** 2 + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    # a stable sort keeps the examples of a cell in ascending order
+    indices = np.argsort(cells, kind='mergesort').astype(np.int32)
+    return {'n_classes': n_classes, 'offsets': offsets, 'indices': indices}
+
+
+def save_cm_indices(fname, cm_indices):
+    """Store an index of get_cm_indices as .npz file."""
+    np.savez(fname, **cm_indices)
+
+
+def load_cm_indices(fname):
+    """
+    Load an index stored with save_cm_indices.
+
+    Pickles with the former n x n nested list format are converted.
+    """
+    if fname.endswith('.pickle'):
+        with open(fname, 'rb') as handle:
+            cm_lists = pickle.load(handle)
+        cells = [cell for row in cm_lists for cell in row]
+        offsets = np.zeros(len(cells) + 1, dtype=np.int64)
+        np.cumsum([len(cell) for cell in cells], out=offsets[1:])
+        indices = np.array([i for cell in cells for i in cell],
+                           dtype=np.int32)
+        return {'n_classes': len(cm_lists),
+                'offsets': offsets,
+                'indices': indices}
+    with np.load(fname) as data:
+        return {'n_classes': int(data['n_classes']),
+                'offsets': data['offsets'],
+                'indices': data['indices']}
+
+
+def select_cm_indices(cm_indices, classes):
+    """
+    Get the examples whose true and predicted class are both in classes.
+
+    Parameters
+    ----------
+    cm_indices : dict
+        See get_cm_indices
+    classes : list of int
+
+    Returns
+    -------
+    np.array
+        Ordered by true class, then predicted class (as in classes).
+    """
+    n = cm_indices['n_classes']
+    offsets = cm_indices['offsets']
+    indices = cm_indices['indices']
+    parts = [indices[offsets[i * n + j]:offsets[i * n + j + 1]]
+             for i in classes for j in classes]
+    if len(parts) == 0:
+        return np.zeros(0, dtype=np.int32)
+    return np.concatenate(parts)
+
+
+def preprocessed_batches(preprocess, X, Y, batch_size, shuffle=True):
+    """
+    Yield batches of X which get preprocessed only when they are needed.
+
+    This allows keeping X in its compact form (e.g. uint8) during training.
+
+    Parameters
+    ----------
+    preprocess : callable
+        The `preprocess` function of the dataset module
+    X : np.array
+    Y : np.array
+    batch_size : int
+    shuffle : bool
+
+    Returns
+    -------
+    generator
+        Infinite generator of (X_batch, Y_batch) tuples
+    """
+    n = len(X)
+    while True:
+        if shuffle:
+            index_array = np.random.permutation(n)
+        else:
+            index_array = np.arange(n)
+        for start in range(0, n, batch_size):
+            batch_index = index_array[start:start + batch_size]
+            yield preprocess(X[batch_index]), Y[batch_index]
+
+
+def preprocessed_statistics(preprocess, X, covariance=False,
+                            chunk_size=1000):
+    """
+    Compute the statistics of preprocess(X) chunk by chunk.
+
+    The preprocessed (float) data is never in memory at once.
+
+    Parameters
+    ----------
+    preprocess : callable
+        The `preprocess` function of the dataset module
+    X : np.array
+    covariance : bool
+        Also compute the covariance matrix (needed for ZCA whitening)
+    chunk_size : int
+
+    Returns
+    -------
+    dict
+        Statistics for `ImageDataGenerator.fit_from_statistics`
+    """
+    from utils import RunningStatistics
+    channel_axis = 0 if K.image_data_format() == 'channels_first' else -1
+    statistics = RunningStatistics(channel_axis=channel_axis,
+                                   covariance=covariance)
+    for start in range(0, len(X), chunk_size):
+        statistics.update(preprocess(X[start:start + chunk_size]))
+    return {'channel_mean': statistics.channel_mean,
+            'channel_std': statistics.channel_std,
+            'mean': statistics.mean,
+            'covariance': statistics.covariance}
+
+
 def get_nonexistant_path(fname_path):
     """
     Get the path to a filename which does not exist by incrementing path.
@@ -187,18 +364,12 @@ def handle_hierarchies(config, data_module, X_train, y_train, X_test, y_test,
         data_module.n_classes = len(old_cli2new_cli)
         X_train, y_train = filter_by_class(X_train, y_train, remaining_cls)
         if index_file is not None:
-            with open(index_file, 'rb') as handle:
-                cm_indices = pickle.load(handle)
-            remaining_idx = []
-            print("Length of index matrix: {}x{}"
-                  .format(len(cm_indices), len(cm_indices[0])))
-            remaining_cls_n = [flatten_completely(hierarchy).index(c)
-                               for c in remaining_cls]
-            for i in remaining_cls_n:
-                for j in remaining_cls_n:
-                    for class_idx in cm_indices[i][j]:
-                        remaining_idx.append(class_idx)
-            remaining_idx = np.array(remaining_idx)
+            cm_indices = load_cm_indices(index_file)
+            print("Length of index matrix: {n}x{n}"
+                  .format(n=cm_indices['n_classes']))
+            cli2position = get_old_cli2new_cli(hierarchy)
+            remaining_cls_n = [cli2position[c] for c in remaining_cls]
+            remaining_idx = select_cm_indices(cm_indices, remaining_cls_n)
             print("Remaining indices: {}".format(len(remaining_idx)))
 
             X_test = X_test[remaining_idx]
@@ -233,7 +404,16 @@ def main(data_module, model_module, optimizer_module, filename, config,
     print("Data loaded.")
 
     X_train, y_train = data['x_train'], data['y_train']
-    X_train = data_module.preprocess(X_train)
+
+    # With lazy_preprocess, X_train stays uint8 and gets preprocessed
+    # batchwise. This is the default for data which is no numpy array but
+    # stays on disk (e.g. a RecordStore), so batches are read from it.
+    lazy = config['dataset'].get('lazy_preprocess',
+                                 not isinstance(X_train, np.ndarray))
+    da = config['train']['data_augmentation']
+
+    if not lazy:
+        X_train = data_module.preprocess(X_train)
 
     # Get use_val value
     if 'use_val' in config['train']:
@@ -246,8 +426,14 @@ def main(data_module, model_module, optimizer_module, filename, config,
         X_test, y_test = data['x_val'], data['y_val']
     else:
         X_test, y_test = data['x_test'], data['y_test']
-        X_val = data_module.preprocess(data['x_val'])
-        X_train = np.append(X_train, X_val, axis=0)
+        X_val = data['x_val']
+        if not lazy:
+            X_val = data_module.preprocess(X_val)
+        if hasattr(X_train, 'concatenate'):
+            # e.g. a RecordStore, which reads from the shards of both
+            X_train = X_train.concatenate(X_val)
+        else:
+            X_train = np.append(X_train, X_val, axis=0)
         y_train = np.append(y_train, data['y_val'], axis=0)
     X_test = data_module.preprocess(X_test)
 
@@ -266,7 +452,6 @@ def main(data_module, model_module, optimizer_module, filename, config,
     img_rows = data_module.img_rows
     img_cols = data_module.img_cols
     img_channels = data_module.img_channels
-    da = config['train']['data_augmentation']
 
     # Convert class vectors to binary class matrices.
     Y_train = np_utils.to_categorical(y_train, nb_classes)
@@ -370,12 +555,22 @@ def main(data_module, model_module, optimizer_module, filename, config,
             model.save(model_chk_path.format(epoch=0)
                        .replace('.00.', '.00.a.'))
         t0 = time.time()
-        model.fit(X_train, Y_train,
-                  batch_size=batch_size,
-                  epochs=nb_epoch,
-                  validation_data=(X_test, Y_test),
-                  shuffle=True,
-                  callbacks=callbacks)
+        if lazy:
+            steps = int(np.ceil(X_train.shape[0] / float(batch_size)))
+            model.fit_generator(preprocessed_batches(data_module.preprocess,
+                                                     X_train, Y_train,
+                                                     batch_size),
+                                steps_per_epoch=steps,
+                                epochs=nb_epoch,
+                                validation_data=(X_test, Y_test),
+                                callbacks=callbacks)
+        else:
+            model.fit(X_train, Y_train,
+                      batch_size=batch_size,
+                      epochs=nb_epoch,
+                      validation_data=(X_test, Y_test),
+                      shuffle=True,
+                      callbacks=callbacks)
         t1 = time.time()
         t2 = t1
         epochs_augmented_training = 0
@@ -417,7 +612,21 @@ def main(data_module, model_module, optimizer_module, filename, config,
 
         # Compute quantities required for featurewise normalization
         # (std, mean, and principal components if ZCA whitening is applied).
-        datagen.fit(X_train, seed=0)
+        if 'statistics_path' in da:
+            # precomputed with create_statistics.py
+            datagen.fit_from_statistics(np.load(da['statistics_path']))
+            np.random.seed(0)
+        elif not lazy:
+            datagen.fit(X_train, seed=0)
+        elif da['featurewise_center'] or da['zca_whitening']:
+            # Same as fit (without augmentation), chunk by chunk
+            statistics = preprocessed_statistics(data_module.preprocess,
+                                                 X_train,
+                                                 covariance=da['zca_whitening'])
+            datagen.fit_from_statistics(statistics)
+            np.random.seed(0)
+        else:
+            np.random.seed(0)
 
         # Apply normalization to test data
         for i in range(len(X_test)):
@@ -429,24 +638,48 @@ def main(data_module, model_module, optimizer_module, filename, config,
             model.save(model_chk_path.format(epoch=0).replace('.00.',
                                                               '.00.a.'))
         t0 = time.time()
-        model.fit_generator(datagen.flow(X_train, Y_train,
-                            batch_size=batch_size),
+        # With workers > 0, batches are augmented by worker processes.
+        # Otherwise n_buffers > 0 reuses the batch buffers; it has to be
+        # bigger than max_q_size of fit_generator (10) + 1.
+        # With lazy_preprocess, every batch is preprocessed before it gets
+        # augmented, as the whole X_train is otherwise.
+        workers = da.get('workers', 0)
+        train_flow = datagen.flow(X_train, Y_train,
+                                  batch_size=batch_size,
+                                  workers=workers,
+                                  n_buffers=da.get('n_buffers', 0),
+                                  preprocess=(data_module.preprocess
+                                              if lazy else None))
+        model.fit_generator(train_flow,
                             steps_per_epoch=steps_per_epoch,
                             epochs=nb_epoch,
                             validation_data=(X_test, Y_test),
                             callbacks=callbacks)
+        if workers > 0:
+            train_flow.close()
         t1 = time.time()
         # Train one epoch without augmentation to make sure data distribution
         # is fit well
         loss_history = history_cb.history["loss"]
         epochs_augmented_training = len(loss_history)
-        model.fit(X_train, Y_train,
-                  batch_size=batch_size,
-                  epochs=nb_epoch,
-                  validation_data=(X_test, Y_test),
-                  shuffle=True,
-                  callbacks=callbacks,
-                  initial_epoch=len(loss_history))
+        if lazy:
+            steps = int(np.ceil(X_train.shape[0] / float(batch_size)))
+            model.fit_generator(preprocessed_batches(data_module.preprocess,
+                                                     X_train, Y_train,
+                                                     batch_size),
+                                steps_per_epoch=steps,
+                                epochs=nb_epoch,
+                                validation_data=(X_test, Y_test),
+                                callbacks=callbacks,
+                                initial_epoch=len(loss_history))
+        else:
+            model.fit(X_train, Y_train,
+                      batch_size=batch_size,
+                      epochs=nb_epoch,
+                      validation_data=(X_test, Y_test),
+                      shuffle=True,
+                      callbacks=callbacks,
+                      initial_epoch=len(loss_history))
         t2 = time.time()
     loss_history = history_cb.history["loss"]
     acc_history = history_cb.history["acc"]
@@ -12,14 +12,11 @@ For more information, see
 
 import json
 import numpy as np
-import matplotlib.pyplot as plt
 import random
 random.seed(0)
 import logging
 import sys
 import os
-from mpl_toolkits.axes_grid1 import make_axes_locatable
-from sklearn.metrics import silhouette_score
 
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
                     level=logging.DEBUG,
@@ -253,6 +250,9 @@ def simulated_annealing(current_cm,
 
 def plot_cm(cm, zero_diagonal=False, labels=None):
     """Plot a confusion matrix."""
+    # matplotlib is slow to import and only needed here
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.axes_grid1 import make_axes_locatable
     n = len(cm)
     if zero_diagonal:
         for i in range(n):
@@ -518,6 +518,7 @@ def main(cm_file, perm_file, steps, labels_file, limit_classes=None):
         if el == 1:
             cluster_i += 1
         y_pred.append(cluster_i)
+    from sklearn.metrics import silhouette_score
     print("silhouette_score={}".format(silhouette_score(cm, y_pred)))
     # Store grouping as hierarchy
     with open('hierarchy.tmp.json', 'w') as outfile: